@@ -0,0 +1,143 @@
+# Benchmarks for the AI side. Run from the game directory:
+#   python -m bench.AIBench [headless] [placement] [eventlog]
+
+from panda3d.core import *
+from direct.task.TaskManagerGlobal import taskMgr
+from otp.ai import CpuPlacement
+from otp.ai.AITaskProfiler import processTime
+from otp.ai.BufferedEventLog import BufferedEventLog
+import __builtin__
+import argparse
+import socket
+import time
+
+
+def benchmarkHeadless(nodeCount=5000, frames=300, moving=0.1):
+    """
+    Times the per-frame scene work of a shard holding nodeCount distributed
+    nodes, moving fraction of which move every frame: once with igLoop
+    rendering (renderFrame) and once headless. Returns the CPU seconds
+    per frame of each, (rendering, headless).
+    """
+    render = NodePath('render')
+    nodes = [render.attachNewNode('node-%d' % i) for i in xrange(nodeCount)]
+    movers = nodes[:int(nodeCount * moving)]
+    graphicsEngine = GraphicsEngine()
+
+    def run(renderFrame):
+        start = processTime()
+        for frame in xrange(frames):
+            for node in movers:
+                node.setFluidPos(frame, 0, 0)
+            PandaNode.resetAllPrevTransform()
+            if renderFrame:
+                graphicsEngine.renderFrame()
+            elif PStatClient.isConnected():
+                PStatClient.mainTick()
+        return (processTime() - start) / frames
+
+    return run(True), run(False)
+
+
+def _tickWorker(cpus, ticks, period, work, results):
+    # A stand-in shard: a frame of busy work every period seconds. Reports
+    # how late each tick finished against its schedule.
+    if cpus:
+        CpuPlacement.setProcessAffinity(cpus)
+    lateness = []
+    deadline = time.time()
+    for i in xrange(ticks):
+        end = time.time() + work
+        while time.time() < end:
+            pass
+        deadline += period
+        delay = deadline - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        lateness.append(max(0.0, time.time() - deadline))
+    results.put(lateness)
+
+
+def _runTickWorkers(plan, ticks, period, work):
+    import multiprocessing
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_tickWorker, args=(cpus, ticks, period, work, results))
+               for cpus in plan]
+    for worker in workers:
+        worker.start()
+    lateness = []
+    for worker in workers:
+        lateness.extend(results.get())
+    for worker in workers:
+        worker.join()
+
+    lateness.sort()
+    return (lateness[len(lateness) // 2], lateness[min(len(lateness) - 1, int(len(lateness) * 0.99))],
+            lateness[-1])
+
+
+def benchmarkCpuPlacement(numProcesses=None, ticks=300, period=1.0 / 30.0, work=0.01, reserved=0):
+    """
+    Runs numProcesses stand-in shards (one per CPU by default), each doing
+    work seconds of busy work every period seconds, first unpinned and then
+    pinned by planPlacement. Returns {'unpinned': ..., 'pinned': ...} with
+    the p50, p99 and max tick lateness in seconds.
+    """
+    topology = CpuPlacement.readHostTopology()
+    if numProcesses is None:
+        numProcesses = sum([len(node) for node in topology])
+    plan = CpuPlacement.planPlacement(numProcesses, topology, reserved)
+    return {'unpinned': _runTickWorkers([None] * numProcesses, ticks, period, work),
+            'pinned': _runTickWorkers(plan, ticks, period, work)}
+
+
+def benchmarkEventLog(count=50000, spoolFilename='logs/eventlog-benchmark.spool'):
+    """
+    Writes count events through a BufferedEventLog to a local UDP sink and
+    returns (events per second, stats). The sink never reads, so this
+    measures the AI side only.
+    """
+    if not hasattr(__builtin__, 'globalClock'):
+        __builtin__.globalClock = ClockObject.getGlobalClock()
+        __builtin__.taskMgr = taskMgr
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    host, port = sink.getsockname()
+    eventLog = BufferedEventLog(host, port, 'benchmark', spoolFilename)
+    try:
+        start = time.time()
+        for i in xrange(count):
+            eventLog.writeServerEvent('avatarChosen', 100000000 + i, 1000000 + i, slot=i % 6)
+        eventLog.flush()
+        elapsed = time.time() - start
+    finally:
+        eventLog.stop()
+        eventLog.spool.clear()
+        sink.close()
+
+    return count / elapsed, eventLog.getStats()
+
+
+if __name__ == '__main__':
+    names = ('headless', 'placement', 'eventlog')
+    parser = argparse.ArgumentParser(description='Toontown BR - AI benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help='Any of %s (default: all of them).' % ', '.join(names))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in names:
+            parser.error('unknown benchmark: %s' % name)
+    benchmarks = args.benchmarks or names
+
+    if 'headless' in benchmarks:
+        rendering, headless = benchmarkHeadless()
+        print 'igLoop: renderFrame %.3f ms, headless %.3f ms per frame' % (rendering * 1000.0, headless * 1000.0)
+
+    if 'placement' in benchmarks:
+        results = benchmarkCpuPlacement()
+        for mode in ('unpinned', 'pinned'):
+            print '%-9s tick lateness p50 %.3f ms, p99 %.3f ms, max %.3f ms' % (
+                (mode,) + tuple([value * 1000.0 for value in results[mode]]))
+
+    if 'eventlog' in benchmarks:
+        rate, stats = benchmarkEventLog()
+        print 'eventlog: %.0f events/s, %d frames, %d spooled' % (rate, stats.get('frames', 0), stats.get('spooled', 0))
@@ -0,0 +1,97 @@
+# Benchmarks for the nametags. benchmarkChatBalloon and benchmarkMarginProps
+# need a client's fonts, models and NametagGroups, so only the MarginManager
+# one runs on its own, from the game directory:
+#   python -m bench.NametagBench
+
+from panda3d.core import *
+from libotp.nametag import NametagGlobals
+from libotp.nametag.MarginManager import MarginManager
+from libotp.nametag.MarginPopup import MarginPopup
+import time
+
+
+class _BenchmarkPopup(MarginPopup):
+    def __init__(self, score, wants_visible):
+        MarginPopup.__init__(self)
+        self.m_score = score
+        self.m_wants_visible = wants_visible
+        self.m_objcode = 0
+
+    def setObjectCode(self, objcode):
+        self.m_objcode = objcode
+
+    def getObjectCode(self):
+        return self.m_objcode
+
+    def considerVisible(self):
+        return self.m_wants_visible
+
+    def getScore(self):
+        return self.m_score
+
+
+def benchmarkMarginManager(num_whispers=300, num_offscreen=300, frames=1000):
+    """
+    Returns the average seconds per MarginManager.update with the given
+    number of whispers (all competing for the cells) and off-screen
+    nametags (not wanting a cell), over frames steady frames.
+    """
+    manager = MarginManager()
+    root = NodePath(manager)
+    for i in xrange(6):
+        manager.addGridCell(i, 0, -1.0, 1.0, -1.0, 1.0, root, Point3(0))
+
+    for i in xrange(num_whispers):
+        manager.managePopup(_BenchmarkPopup(2000 - i, True))
+
+    for i in xrange(num_offscreen):
+        manager.managePopup(_BenchmarkPopup(0, False))
+
+    manager.update()
+    start = time.time()
+    for i in xrange(frames):
+        manager.update()
+
+    return (time.time() - start) / frames
+
+
+def benchmarkChatBalloon(balloon, font, texts, count=1000):
+    """
+    Returns balloons generated per second with and without the cache,
+    cycling through texts.
+    """
+    args = (font, 10.0, Vec4(0, 0, 0, 1), Vec4(1, 1, 1, 1), False, False, 0, None, False, False)
+    start = time.time()
+    for i in xrange(count):
+        balloon.generate_uncached(texts[i % len(texts)], *args)
+    uncached = count / (time.time() - start)
+
+    balloon.clear_cache()
+    start = time.time()
+    for i in xrange(count):
+        balloon.generate(texts[i % len(texts)], *(args + ([None],)))
+    cached = count / (time.time() - start)
+
+    return uncached, cached
+
+
+def benchmarkMarginProps(groups, count=10):
+    """
+    Times a global margin property change (what setMin2dAlpha and friends
+    trigger) with the given NametagGroups in view. Returns the average
+    seconds per change.
+    """
+    start = time.time()
+    for i in xrange(count):
+        NametagGlobals._margin_prop_seq += 1
+        for group in groups:
+            group.getNametag2d().considerVisible()
+            group.updateContentsAll()
+
+    return (time.time() - start) / count
+
+
+if __name__ == '__main__':
+    for num_whispers in (0, 30, 300):
+        print '%3d whispers: %.3f ms per MarginManager.update' % (
+            num_whispers, benchmarkMarginManager(num_whispers) * 1000.0)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# Benchmarks for the UberDOG side. Run from the game directory:
+#   python -m bench.UberDOGBench [bridge] [avatars] [namefilter] [login] [shards]
+
+from otp.uberdog.ClientManagerUD import DbmBridgeStore, LogBridgeStore, SqliteBridgeStore, \
+    AvatarBatchQuery, ClientManagerUD
+from otp.uberdog.NameFilter import NameFilter
+from otp.uberdog.LoginVerifier import LoginVerifier, DEFAULT_LOGIN_KEY, signLoginToken
+from otp.uberdog.ConsistentHashRing import ConsistentHashRing
+
+import argparse, hmac, multiprocessing, os, random, time, threading, Queue
+
+
+def benchmarkBridgeStores(count=10000, batchSize=256):
+    """
+    Simulates count first-time logins against each bridge store: a lookup
+    that misses, then a write, group-committed batchSize at a time. The old
+    bridge synced anydbm on every login; that is the 'anydbm-sync' row.
+    Returns {name: (logins per second, lookup p50, lookup p99)}.
+    """
+    import shutil, tempfile
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        for name, storeType, commitEvery in (('anydbm-sync', DbmBridgeStore, 1),
+                                             ('anydbm', DbmBridgeStore, batchSize),
+                                             ('log', LogBridgeStore, batchSize),
+                                             ('sqlite', SqliteBridgeStore, batchSize)):
+            store = storeType(os.path.join(directory, name))
+            lookupTimes = []
+            start = time.time()
+            for i in xrange(count):
+                userId = str(1000000 + i)
+                lookupStart = time.time()
+                store.get(userId)
+                lookupTimes.append(time.time() - lookupStart)
+                store.put(userId, 100000000 + i)
+                if (i + 1) % commitEvery == 0:
+                    store.commit()
+            store.commit()
+            elapsed = time.time() - start
+            store.close()
+
+            lookupTimes.sort()
+            results[name] = (count / elapsed, lookupTimes[len(lookupTimes) // 2],
+                             lookupTimes[int(len(lookupTimes) * 0.99)])
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+
+
+class StandInDatabase:
+    # A stand-in for the database server, for benchmarkAvatarQuery. One
+    # thread answers queryObject in order, taking latency seconds per
+    # request plus fieldCost per field it returns; poll() runs the callbacks.
+
+    def __init__(self, objects, latency, fieldCost):
+        self.objects = objects
+        self.latency = latency
+        self.fieldCost = fieldCost
+        self.requests = Queue.Queue()
+        self.responses = Queue.Queue()
+        thread = threading.Thread(target=self.__serve, name='StandInDatabase')
+        thread.setDaemon(True)
+        thread.start()
+
+    def queryObject(self, dbId, doId, callback, dclass=None, fieldNames=None):
+        self.requests.put((doId, callback, dclass, fieldNames))
+
+    def __serve(self):
+        while True:
+            doId, callback, dclass, fieldNames = self.requests.get()
+            fields = self.objects[doId]
+            if fieldNames is not None:
+                fields = dict([(name, fields[name]) for name in fieldNames if name in fields])
+            time.sleep(self.latency + self.fieldCost * len(fields))
+            self.responses.put((callback, dclass, fields))
+
+    def poll(self):
+        while True:
+            try:
+                callback, dclass, fields = self.responses.get_nowait()
+            except Queue.Empty:
+                return
+            callback(dclass, fields)
+
+
+def benchmarkAvatarQuery(count=200, numAvatars=6, numFields=100, latency=0.0005, fieldCost=0.00001):
+    """
+    Times fetching an avatar list of numAvatars toons from a StandInDatabase
+    with numFields fields per toon, count times: once asking for every field
+    (as the avatar chooser used to) and once for AVATAR_LIST_FIELDS only.
+    Returns {'all': (mean, p99), 'listFields': (mean, p99)} in seconds.
+    """
+    class StandInAir:
+        dbId = 4003
+
+    dclass = 'DistributedToonUD'
+    objects = {}
+    for avId in xrange(100000001, 100000001 + numAvatars):
+        fields = dict([('field%d' % i, (i,)) for i in xrange(numFields - 4)])
+        fields.update({'setName': ('Toon %d' % avId,), 'setDNAString': ('t' * 64,),
+                       'WishNameState': ('OPEN',), 'WishName': ('',)})
+        objects[avId] = fields
+
+    air = StandInAir()
+    air.dbInterface = StandInDatabase(objects, latency, fieldCost)
+    results = {}
+    for name, fieldNames in (('all', None), ('listFields', ClientManagerUD.AVATAR_LIST_FIELDS)):
+        latencies = []
+        for i in xrange(count):
+            done = []
+            start = time.time()
+            AvatarBatchQuery(air, dclass, objects.keys(), fieldNames, done.append)
+            while not done:
+                air.dbInterface.poll()
+                time.sleep(0.0001)
+            latencies.append(time.time() - start)
+
+        latencies.sort()
+        results[name] = (sum(latencies) / len(latencies), latencies[int(len(latencies) * 0.99)])
+
+    return results
+
+
+def benchmarkNameFilter(nameFilter, count=100000, seed=0):
+    """
+    Times nameFilter.isAllowed over count generated names and returns
+    (seconds, names per second, names rejected).
+    """
+    rng = random.Random(seed)
+    letters = u'abcdefghijklmnopqrstuvwxyzáâãçéêíóôõú0134@'
+    names = []
+    for i in xrange(count):
+        parts = []
+        for j in xrange(rng.randint(1, 3)):
+            parts.append(u''.join([rng.choice(letters) for k in xrange(rng.randint(3, 10))]).capitalize())
+        names.append(u' '.join(parts).encode('utf-8'))
+
+    start = time.time()
+    rejected = 0
+    for name in names:
+        if not nameFilter.isAllowed(name):
+            rejected += 1
+    elapsed = time.time() - start
+
+    return elapsed, count / elapsed if elapsed else 0.0, rejected
+
+
+def benchmarkLoginVerifier(verifier, count=100000, batchSize=100):
+    """
+    Returns the verifications per second of verify() and of verifyBatch()
+    with batches of batchSize, on count distinct tokens.
+    """
+    logins = [('token-%d' % i, signLoginToken('token-%d' % i)) for i in xrange(count)]
+
+    start = time.time()
+    for token, authKey in logins:
+        verifier.verify(token, authKey)
+    single = count / (time.time() - start)
+
+    start = time.time()
+    for i in xrange(0, count, batchSize):
+        verifier.verifyBatch(logins[i:i + batchSize])
+    batched = count / (time.time() - start)
+
+    return single, batched
+
+
+def _loadTestShard(shardCount, shardIndex, logins, workPerLogin, results):
+    # One ClientManagerUD stand-in. Like the real ones it sees every login,
+    # drops the ones that hash elsewhere and, for its own, checks the HMAC
+    # and spends workPerLogin seconds standing in for the rest of the login.
+    ring = ConsistentHashRing(['shard-%d' % i for i in xrange(shardCount)])
+    shardName = 'shard-%d' % shardIndex
+    verifier = LoginVerifier([DEFAULT_LOGIN_KEY])
+    handled = 0
+    start = time.time()
+    for cookie, authKey in logins:
+        if shardCount > 1 and ring.getNode(cookie) != shardName:
+            continue
+        verifier.verify(cookie, authKey)
+        end = time.time() + workPerLogin
+        while time.time() < end:
+            pass
+        handled += 1
+    results.put((handled, time.time() - start))
+
+
+def loadTestShards(maxShards=4, count=20000, workPerLogin=0.0002):
+    """
+    Runs 1..maxShards ClientManagerUD stand-ins in their own processes over
+    the same count logins and returns [(shards, logins per second)], the
+    rate being count over the time the slowest shard took.
+    """
+    logins = [('token-%d' % i, signLoginToken('token-%d' % i)) for i in xrange(count)]
+    rates = []
+    for shardCount in xrange(1, maxShards + 1):
+        results = multiprocessing.Queue()
+        shards = [multiprocessing.Process(target=_loadTestShard,
+                                          args=(shardCount, i, logins, workPerLogin, results))
+                  for i in xrange(shardCount)]
+        for shard in shards:
+            shard.start()
+        elapsed = max([results.get()[1] for shard in shards])
+        for shard in shards:
+            shard.join()
+        rates.append((shardCount, count / elapsed))
+
+    return rates
+
+
+if __name__ == '__main__':
+    names = ('bridge', 'avatars', 'namefilter', 'login', 'shards')
+    parser = argparse.ArgumentParser(description='Toontown BR - UberDOG benchmarks')
+    parser.add_argument('--name-filter', help='Banned word list to benchmark the name filter with.')
+    parser.add_argument('benchmarks', nargs='*', help='Any of %s (default: all of them).' % ', '.join(names))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in names:
+            parser.error('unknown benchmark: %s' % name)
+    benchmarks = args.benchmarks or names
+
+    if 'bridge' in benchmarks:
+        for name, (rate, p50, p99) in sorted(benchmarkBridgeStores().items()):
+            print '%-12s %9.0f logins/s, lookup p50 %.3f ms, p99 %.3f ms' % (name, rate, p50 * 1000.0, p99 * 1000.0)
+
+    if 'avatars' in benchmarks:
+        for name, (mean, p99) in sorted(benchmarkAvatarQuery().items()):
+            print '%-12s avatar list mean %.2f ms, p99 %.2f ms' % (name, mean * 1000.0, p99 * 1000.0)
+
+    if 'namefilter' in benchmarks:
+        if args.name_filter:
+            nameFilter = NameFilter.load(args.name_filter)
+        else:
+            rng = random.Random(1)
+            nameFilter = NameFilter([''.join([rng.choice('abcdefghijklmnopqrstuvwxyz') for i in xrange(rng.randint(3, 8))])
+                                     for j in xrange(5000)])
+        elapsed, rate, rejected = benchmarkNameFilter(nameFilter)
+        print '%d banned words: %.3fs, %.0f names/s, %d rejected' % (nameFilter.size, elapsed, rate, rejected)
+
+    if 'login' in benchmarks:
+        for name, verifier in (('sha256', LoginVerifier([DEFAULT_LOGIN_KEY])),
+                               ('sha256+md5', LoginVerifier([DEFAULT_LOGIN_KEY], legacyDigests=('md5',)))):
+            single, batched = benchmarkLoginVerifier(verifier)
+            print '%-12s %9.0f verifications/s, %9.0f batched' % (name, single, batched)
+
+        # For comparison, the old per-login hmac.new with == on the hexdigest:
+        count = 100000
+        start = time.time()
+        for i in xrange(count):
+            hmac.new(DEFAULT_LOGIN_KEY, 'token-%d' % i).hexdigest() == 'x'
+        print '%-12s %9.0f verifications/s' % ('old md5', count / (time.time() - start))
+
+    if 'shards' in benchmarks:
+        # How evenly accounts spread over the shards, and how many move when
+        # one more shard is added.
+        accounts = xrange(100000000, 100200000)
+        for count in (2, 4, 8):
+            ring = ConsistentHashRing(['shard-%d' % i for i in xrange(count)])
+            owners = [ring.getNode(accountId) for accountId in accounts]
+            loads = {}
+            for owner in owners:
+                loads[owner] = loads.get(owner, 0) + 1
+            ring.addNode('shard-%d' % count)
+            moved = sum([1 for accountId, owner in zip(accounts, owners) if ring.getNode(accountId) != owner])
+            print '%d shards: min %d max %d accounts per shard; adding one moves %.1f%%' % (
+                count, min(loads.values()), max(loads.values()), moved * 100.0 / len(accounts))
+
+        for shardCount, rate in loadTestShards():
+            print '%d shards: %.0f logins/s' % (shardCount, rate)
@@ -1,5 +1,6 @@
 from direct.directnotify import DirectNotifyGlobal
 from panda3d.core import *
+from collections import OrderedDict
 
 import NametagGlobals
 
@@ -8,7 +9,11 @@ class ChatBalloon:
     notify = DirectNotifyGlobal.directNotify.newCategory('ChatBalloon')
 
     def __init__(self, node=None):
-        self.m_copy_node = None
+        self.m_balloon_state = None
+        self.m_balloon_effects = None
+        self.m_static_piece = None
+        self.m_top_piece = None
+        self.m_middle_piece = None
         self.m_top_node = None
         self.m_top_mat = None
         self.m_middle_node = None
@@ -20,6 +25,15 @@ class ChatBalloon:
         self.m_text_height = 0
         self.m_text_frame = Vec4(0)
 
+        # Generated balloons, most recently used last. Each entry is
+        # (chat node, hscale, text height, text frame, size in bytes).
+        self.m_cache = OrderedDict()
+        self.m_cache_bytes = 0
+        self.m_cache_max_entries = config.GetInt('nametag-balloon-cache-size', 256)
+        self.m_cache_max_bytes = config.GetInt('nametag-balloon-cache-bytes', 4 << 20)
+        self.m_cache_hits = 0
+        self.m_cache_misses = 0
+
         self.scan(node)
 
     @staticmethod
@@ -43,7 +57,7 @@ class ChatBalloon:
         for i in xrange(node.getNumChildren()):
             child = node.getChild(i)
             if child.getName() == 'middle':
-                return n
+                return child
 
             n = ChatBalloon.find_middle_geom(child)
             if n:
@@ -62,8 +76,6 @@ class ChatBalloon:
         return False
 
     def scan_balloon(self, node):
-        self.m_copy_node = node.copySubgraph()
-
         for i in xrange(node.getNumChildren()):
             child = node.getChild(i)
             if child.getName() == 'top':
@@ -79,15 +91,103 @@ class ChatBalloon:
                 self.m_bottom_mat = child.getTransform().getMat()
 
         if self.m_top_node and self.m_middle_node and self.m_bottom_node:
+            self.make_templates(node)
             return True
 
         else:
             self.notify.warning('ChatBalloon geometry does not include top, middle, and bottom nodes.')
             return False
 
+    @staticmethod
+    def make_piece(name, children):
+        # Copies children under a new node and flattens them into it, with
+        # their transforms baked into the vertices.
+        piece = PandaNode(name)
+        for child in children:
+            piece.addChild(child.copySubgraph())
+
+        NodePath(piece).flattenStrong()
+        return piece
+
+    def make_templates(self, node):
+        # Splits the balloon once into the piece that never changes (the
+        # bottom and anything else that isn't stretched) and the top and
+        # middle, each flattened in its own local space. generate only has
+        # to put a stretch transform over each piece.
+        top = self.m_top_node.copySubgraph()
+        top.setTransform(TransformState.makeIdentity())
+        middle = self.m_middle_node.copySubgraph()
+        middle.setTransform(TransformState.makeIdentity())
+
+        self.m_top_piece = ChatBalloon.make_piece('top', [top])
+        self.m_middle_piece = ChatBalloon.make_piece('middle', [middle])
+        self.m_static_piece = ChatBalloon.make_piece(
+            'static', [node.getChild(i) for i in xrange(node.getNumChildren())
+                       if node.getChild(i).getName() not in ('top', 'middle')])
+        self.m_balloon_state = node.getState()
+        self.m_balloon_effects = node.getEffects()
+
+    @staticmethod
+    def get_node_bytes(node):
+        # Rough size of the vertex and index data under node.
+        size = 0
+        for np in [NodePath.anyPath(node)] + list(NodePath.anyPath(node).findAllMatches('**/+GeomNode')):
+            if not np.node().isGeomNode():
+                continue
+            geom_node = np.node()
+            for i in xrange(geom_node.getNumGeoms()):
+                geom = geom_node.getGeom(i)
+                vdata = geom.getVertexData()
+                for j in xrange(vdata.getNumArrays()):
+                    size += vdata.getArray(j).getDataSizeBytes()
+                for j in xrange(geom.getNumPrimitives()):
+                    size += geom.getPrimitive(j).getDataSizeBytes()
+
+        return size
+
+    def clear_cache(self):
+        self.m_cache.clear()
+        self.m_cache_bytes = 0
+
     def generate(self, text, font, wordwrap, text_color, balloon_color, for_3d,
                  has_draw_order, draw_order, page_button, space_for_button,
                  reversed, new_button):  # new_button is a pointer, let's use a list hack here
+        # Most chat is SpeedChat, which says the same few phrases over and
+        # over, so balloons are cached by everything that goes into them.
+        # Callers flatten their own transform into what we return, so each
+        # call gets its own copy of the nodes (the geometry is shared).
+        key = (text, font, wordwrap, tuple(text_color), tuple(balloon_color), bool(for_3d),
+               bool(has_draw_order), draw_order, page_button, bool(space_for_button), bool(reversed))
+        entry = self.m_cache.get(key)
+        if entry is None:
+            self.m_cache_misses += 1
+            chat_node = self.generate_uncached(text, font, wordwrap, text_color, balloon_color, for_3d,
+                                               has_draw_order, draw_order, page_button, space_for_button,
+                                               reversed)
+            entry = (chat_node, self.m_hscale, self.m_text_height, Vec4(self.m_text_frame),
+                     ChatBalloon.get_node_bytes(chat_node))
+            self.m_cache[key] = entry
+            self.m_cache_bytes += entry[4]
+            while self.m_cache and (len(self.m_cache) > self.m_cache_max_entries or
+                                    self.m_cache_bytes > self.m_cache_max_bytes):
+                self.m_cache_bytes -= self.m_cache.popitem(last=False)[1][4]
+
+        else:
+            self.m_cache_hits += 1
+            del self.m_cache[key]
+            self.m_cache[key] = entry
+
+        chat_node, self.m_hscale, self.m_text_height, text_frame, size = entry
+        self.m_text_frame = Vec4(text_frame)
+        chat_node = chat_node.copySubgraph()
+        if page_button and new_button:
+            new_button[0] = NodePath.anyPath(chat_node).find('**/button')
+
+        return chat_node
+
+    def generate_uncached(self, text, font, wordwrap, text_color, balloon_color, for_3d,
+                          has_draw_order, draw_order, page_button, space_for_button,
+                          reversed):
         chat_node = PandaNode('chat')
         chat_node.setAttrib(CullFaceAttrib.make(0))
         text_node = NametagGlobals.getTextNode()
@@ -148,68 +248,55 @@ class ChatBalloon:
 
         self.m_text_frame += Vec4(v137, v137, v139, v139)
 
-        '''
-        Correct code:
-        Python won't let us edit this transform, we'll have to copy it all
-
-        if self.m_top_node:
-            self.m_top_node.setTransform(TransformState.makeMat(top_mat))
-
-        if self.m_middle_node:
-            self.m_middle_node.setTransform(TransformState.makeMat(middle_mat))
-
-        subgraph_copy = self.m_copy_node.copySubgraph()
-        chat_node.addChild(subgraph_copy)
-        subgraph_copy.setTransform(TransformState.makeMat(subgraph_copy_mat))
-        '''
-
-        # BEGIN PYTHON CODE
-        subgraph_copy = self.m_copy_node.copySubgraph()
-        NodePath.anyPath(subgraph_copy).find('**/top').node().setTransform(TransformState.makeMat(top_mat))
-        NodePath.anyPath(subgraph_copy).find('**/middle').node().setTransform(TransformState.makeMat(middle_mat))
-
-        chat_node.addChild(subgraph_copy)
-        subgraph_copy.setTransform(TransformState.makeMat(subgraph_copy_mat))
-        # END PYTHON CODE
+        # The pieces are shared by every balloon; only the nodes holding
+        # this message's stretch are new.
+        chat_np = NodePath(chat_node)
+        balloon_np = chat_np.attachNewNode('chatBalloon')
+        balloon_np.node().setState(self.m_balloon_state)
+        balloon_np.node().setEffects(self.m_balloon_effects)
+        balloon_np.setMat(subgraph_copy_mat)
+        balloon_np.node().addChild(self.m_static_piece)
+        top_np = balloon_np.attachNewNode('top')
+        top_np.setMat(top_mat)
+        top_np.node().addChild(self.m_top_piece)
+        middle_np = balloon_np.attachNewNode('middle')
+        middle_np.setMat(middle_mat)
 
         if has_draw_order:
             bin = config.GetString('nametag-fixed-bin', 'fixed')
-            subgraph_copy.setAttrib(CullBinAttrib.make(bin, draw_order))
+            balloon_np.setAttrib(CullBinAttrib.make(bin, draw_order))
 
-        subgraph_copy.setAttrib(ColorAttrib.makeFlat(balloon_color))
+        balloon_np.setAttrib(ColorAttrib.makeFlat(balloon_color))
         if balloon_color[3] != 1.0:
-            subgraph_copy.setAttrib(TransparencyAttrib.make(1))
-
-        reducer = SceneGraphReducer()
-        reducer.applyAttribs(subgraph_copy)
-        reducer.flatten(chat_node, -1)
+            balloon_np.setAttrib(TransparencyAttrib.make(1))
 
         generated_text = text_node.generate()
         if for_3d:
-            v86 = ChatBalloon.find_middle_geom(chat_node)
-            if not v86:
-                v86 = ChatBalloon.find_geom_node(chat_node)
-
-            v86.setEffect(DecalEffect.make())
+            # The text is decaled onto the middle, so that one piece needs
+            # a copy of its own to carry the text.
+            middle_np.node().addChild(self.m_middle_piece.copySubgraph())
+            np = NodePath.anyPath(ChatBalloon.find_geom_node(middle_np.node()) or middle_np.node())
+            np.node().setEffect(DecalEffect.make())
 
         else:
-            v86 = chat_node
+            middle_np.node().addChild(self.m_middle_piece)
+            np = chat_np
             if has_draw_order:
                 bin = config.GetString('nametag-fixed-bin', 'fixed')
                 generated_text.setAttrib(CullBinAttrib.make(bin, draw_order + 1))
 
-        np = NodePath.anyPath(v86)
         v144 = np.attachNewNode(generated_text)
-        v144.setPos((v137, v138, v139))
+        # -0.01 on Y is a Panda3D 1.10 hack to prevent z-fighting.
+        v144.setMat(chat_np, Mat4.translateMat(v137, v138 - 0.01, v139))
         v144.setColor(text_color)
-        v144.setY(-0.01)  # Panda3D 1.10 hack to prevent z-fighting.
         if text_color[3] != 1.0:
             v144.setTransparency(1)
 
         if page_button:
             v116 = ModelNode('button')
-            new_button[0] = np.attachNewNode(v116)
-            button_copy = page_button.copyTo(new_button[0])
+            button_np = np.attachNewNode(v116)
+            button_np.setMat(chat_np, Mat4.identMat())
+            button_copy = page_button.copyTo(button_np)
             if reversed:
                 button_copy.setPos(self.m_hscale * 1.7, 0, 1.8)
 
@@ -219,8 +306,4 @@ class ChatBalloon:
             button_copy.setScale(8.0, 8.0, 8.0)
             button_copy.setY(-0.01)  # Panda3D 1.10 hack to prevent z-fighting.
 
-        reducer = SceneGraphReducer()
-        reducer.applyAttribs(generated_text)
-        reducer.flatten(chat_node, 1)
-
         return chat_node
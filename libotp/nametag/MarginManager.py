@@ -1,5 +1,8 @@
 from panda3d.core import *
 
+import NametagGlobals
+from MarginPopup import MarginPopup
+
 
 class PopupHandle:
     def __init__(self, popup):
@@ -36,6 +39,10 @@ class MarginManager(PandaNode):
         self.m_code_map = {}  # code: MarginPopup*
         self.m_num_available = 0
 
+        # Set whenever the popups or cells change in a way that needs the
+        # cell assignment redone; see update.
+        self.m_dirty = True
+
     def addGridCell(self, a2, a3, a4, a5, a6, a7, newParent, newPos):
         v7 = (a5 - a4) * 0.16666667
         v8 = (a7 - a6) * 0.16666667
@@ -86,6 +93,8 @@ class MarginManager(PandaNode):
             v5.m_popup = None
             v5.m_objcode = 0
 
+        self.m_dirty = True
+
     def getCellAvailable(self, a2):
         return self.m_cells[a2][0].m_available
 
@@ -96,6 +105,7 @@ class MarginManager(PandaNode):
         a2.setManaged(True)
         self.m_popups[a2] = PopupHandle(a2)
         self.m_code_map[a2.getObjectCode()] = a2
+        self.m_dirty = True
 
     def unmanagePopup(self, a2):
         v9 = self.m_popups.get(a2)
@@ -107,6 +117,7 @@ class MarginManager(PandaNode):
             a2.setManaged(False)
             del self.m_popups[a2]
             del self.m_code_map[v9.m_objcode]
+            self.m_dirty = True
 
     def hide(self, a2):
         cell = self.m_cells[a2][0]
@@ -189,25 +200,93 @@ class MarginManager(PandaNode):
                 v8 = self.chooseCell(v7, cells)
                 self.show(v7, v8)
 
+    def isAssignmentCurrent(self, num_want_visible, num_pending):
+        # True if the cells already hold the popups that should have them,
+        # so update can skip the reassignment.
+        if self.m_dirty:
+            return False
+
+        if num_want_visible <= self.m_num_available:
+            return not num_pending
+
+        # Over capacity: the shown popups must still outrank every other
+        # one. showVisibleResolveConflict ranks popups that don't want to
+        # be visible at score 0.
+        lowest_shown = None
+        highest_hidden = None
+        num_shown = 0
+        for handle in self.m_popups.itervalues():
+            score = handle.m_score if handle.m_wants_visible else 0
+            if handle.m_popup.isVisible():
+                num_shown += 1
+                if lowest_shown is None or score < lowest_shown:
+                    lowest_shown = score
+
+            elif highest_hidden is None or score > highest_hidden:
+                highest_hidden = score
+
+        if num_shown != self.m_num_available:
+            return False
+
+        return highest_hidden is None or (lowest_shown is not None and lowest_shown >= highest_hidden)
+
+    def beginDistanceFrame(self):
+        # Works out the local toon's inverse net transform once per update.
+        # A popup that asks for its distance (only the ones with chat do)
+        # then only costs a lookup of its avatar's own (cached) net
+        # transform, instead of a getPos(toon) that rebuilds the relative
+        # transform every time.
+        NametagGlobals._position_snapshot_seq += 1
+        toon = NametagGlobals._toon
+        if toon.isEmpty():
+            NametagGlobals._toon_inverse_mat = None
+        else:
+            NametagGlobals._toon_inverse_mat = toon.getNetTransform().getInverse().getMat()
+
+    def endDistanceFrame(self):
+        # Tasks later in the frame may still move the toon, so distances
+        # asked for after the update go back to getPos.
+        NametagGlobals._toon_inverse_mat = None
+        NametagGlobals._position_snapshot_seq += 1
+
     def update(self):
+        self.beginDistanceFrame()
+        try:
+            self.updatePopups()
+        finally:
+            self.endDistanceFrame()
+
+    def updatePopups(self):
         num_want_visible = 0
+        num_pending = 0
 
         for handle in self.m_popups.values():
             popup = handle.m_popup
-            handle.m_wants_visible = popup.considerVisible()
+            wants_visible = popup.considerVisible()
+            if bool(wants_visible) != bool(handle.m_wants_visible):
+                self.m_dirty = True
+
+            handle.m_wants_visible = wants_visible
             if handle.m_wants_visible and handle.m_objcode:
                 handle.m_score = popup.getScore()
                 num_want_visible += 1
+                if not popup.isVisible():
+                    num_pending += 1
 
             elif popup.isVisible():
                 self.hide(handle.m_cell)
                 handle.m_cell = -1
 
-        if num_want_visible > self.m_num_available:
-            self.showVisibleResolveConflict()
+        # Most frames nothing moves between cells, so only redo the
+        # assignment when the visible set or the ranking changed.
+        if not self.isAssignmentCurrent(num_want_visible, num_pending):
+            if num_want_visible > self.m_num_available:
+                self.showVisibleResolveConflict()
 
-        else:
-            self.showVisibleNoConflict()
+            else:
+                self.showVisibleNoConflict()
+
+            self.m_dirty = False
 
         for popup in self.m_popups.keys():
             popup.frameCallback()
@@ -0,0 +1,112 @@
+from panda3d.core import *
+from direct.directnotify import DirectNotifyGlobal
+from collections import OrderedDict
+
+import NametagGlobals
+
+
+class NameGeometryCache:
+    """
+    Name text and name card geometry, built once per set of inputs and
+    shared by every nametag that shows them. Nametags instance the text
+    and take a copy of the card's nodes (the Geoms are shared), so a
+    margin property change only costs lookups instead of rebuilding
+    every name on screen.
+    """
+    notify = DirectNotifyGlobal.directNotify.newCategory('NameGeometryCache')
+
+    def __init__(self, max_entries=512):
+        self.m_max_entries = max_entries
+        self.m_texts = OrderedDict()
+        self.m_cards = OrderedDict()
+        self.m_hits = 0
+        self.m_misses = 0
+
+    def __lookup(self, cache, key):
+        entry = cache.get(key)
+        if entry is None:
+            self.m_misses += 1
+            return None
+
+        self.m_hits += 1
+        del cache[key]
+        cache[key] = entry
+        return entry
+
+    def __store(self, cache, key, entry):
+        cache[key] = entry
+        while len(cache) > self.m_max_entries:
+            cache.popitem(last=False)
+
+    def getText(self, name, font, wordwrap, shadow):
+        # Returns (node, frame) for the name; shadow is None or an (x, y)
+        # offset for a black drop shadow.
+        key = (name, font, wordwrap, shadow)
+        entry = self.__lookup(self.m_texts, key)
+        if entry is not None:
+            return entry[0], Vec4(entry[1])
+
+        text_node = NametagGlobals.getTextNode()
+        text_node.setFont(font)
+        text_node.setWordwrap(wordwrap)
+        text_node.setAlign(TextNode.ACenter)
+        text_node.setText(name)
+        node = text_node.generate()
+        frame = Vec4(text_node.getCardActual())
+
+        if shadow is not None:
+            gen = node
+            node = PandaNode('name')
+            node.addChild(gen)
+
+            pos = Point3(shadow[0], 0, -shadow[1])
+            attached = NodePath.anyPath(node).attachNewNode(gen.copySubgraph())
+            attached.setPos(pos)
+            attached.setColor(0, 0, 0, 1)
+
+        self.__store(self.m_texts, key, (node, frame))
+        return node, Vec4(frame)
+
+    def getCard(self, frame, color):
+        # Returns a new copy of a name card's nodes; the Geoms are shared
+        # with every other card like it. With a nametag card model set, the
+        # card is the model's root and its GeomNode is further down, so this
+        # has to copy the whole subgraph, not just the top node.
+        key = (tuple(frame), tuple(color), NametagGlobals._nametag_card,
+               tuple(NametagGlobals._nametag_card_frame))
+        card = self.__lookup(self.m_cards, key)
+        if card is None:
+            card_maker = CardMaker('nametag')
+            card_maker.setFrame(frame)
+            card_maker.setColor(color)
+            if NametagGlobals._nametag_card:
+                card_maker.setSourceGeometry(NametagGlobals._nametag_card.node(),
+                                             NametagGlobals._nametag_card_frame)
+
+            card = card_maker.generate()
+            if NodePath(card).find('**/+GeomNode').isEmpty():
+                self.notify.warning('Name card %s has no geometry.' % card.getName())
+            self.__store(self.m_cards, key, card)
+
+        return card.copySubgraph()
+
+    def clear(self):
+        self.m_texts.clear()
+        self.m_cards.clear()
+
+
+_name_geometry_cache = NameGeometryCache()
+
+
+def getNameGeometryCache():
+    return _name_geometry_cache
+
+
+def checkCard():
+    """
+    Returns True if a name card built from the current nametag card
+    settings (see NametagGlobals.setNametagCard) has geometry to draw.
+    """
+    card = NodePath(_name_geometry_cache.getCard(Vec4(-1, 1, -0.5, 0.5), Vec4(1)))
+    geom_np = card.find('**/+GeomNode')
+    return not geom_np.isEmpty() and geom_np.node().getNumGeoms() > 0
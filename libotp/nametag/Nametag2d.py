@@ -3,6 +3,7 @@ import math
 from panda3d.core import *
 
 import NametagGlobals
+from NameGeometryCache import getNameGeometryCache
 from MarginPopup import MarginPopup
 from Nametag import Nametag
 from _constants import *
@@ -33,6 +34,10 @@ class Nametag2d(Nametag, MarginPopup):
 
         self.m_trans_vec = Vec3(0, 0, 0)
 
+        # getDistance2's result for the current MarginManager update:
+        self.m_distance2 = 0
+        self.m_distance2_seq = -1
+
     def setVisible(self, value):
         self.m_visible = value
         self.updateContents()
@@ -61,17 +66,30 @@ class Nametag2d(Nametag, MarginPopup):
 
         return 0
 
-    def getDistance2(self):
+    def getAvatarNodePath(self):
         if self.m_avatar:
-            np = self.m_avatar
+            return self.m_avatar
 
-        else:
-            np = self.m_group.getAvatar()
+        if self.m_group:
+            return self.m_group.getAvatar()
 
-        if np.isEmpty():
+        return None
+
+    def getDistance2(self):
+        if self.m_distance2_seq == NametagGlobals._position_snapshot_seq:
+            return self.m_distance2
+
+        np = self.getAvatarNodePath()
+        if np is None or np.isEmpty():
             return 0
 
-        return np.getPos(NametagGlobals._toon).lengthSquared()
+        mat = NametagGlobals._toon_inverse_mat
+        if mat is None:
+            return np.getPos(NametagGlobals._toon).lengthSquared()
+
+        self.m_distance2 = mat.xformPoint(np.getNetTransform().getPos()).lengthSquared()
+        self.m_distance2_seq = NametagGlobals._position_snapshot_seq
+        return self.m_distance2
 
     def considerVisible(self):
         from NametagGroup import NametagGroup
@@ -194,16 +212,11 @@ class Nametag2d(Nametag, MarginPopup):
         a3 = v69
 
         if v75[3] != 0.0:
-            card = CardMaker('nametag')
-            card.setFrame(self.m_group.m_name_frame[0] - NametagGlobals._card_pad[0],
-                          self.m_group.m_name_frame[1] + NametagGlobals._card_pad[1],
-                          v68, v67)
-            card.setColor(v75)
-            if NametagGlobals._nametag_card:
-                card.setSourceGeometry(NametagGlobals._nametag_card.node(),
-                                       NametagGlobals._nametag_card_frame)
-
-            self.m_attached_np = self.m_np.attachNewNode(card.generate())
+            card = getNameGeometryCache().getCard(
+                Vec4(self.m_group.m_name_frame[0] - NametagGlobals._card_pad[0],
+                     self.m_group.m_name_frame[1] + NametagGlobals._card_pad[1],
+                     v68, v67), v75)
+            self.m_attached_np = self.m_np.attachNewNode(card)
             self.m_attached_np.setMat(v69)
             if v75[3] != 1.0:
                 self.m_attached_np.setTransparency(1)
@@ -212,7 +225,7 @@ class Nametag2d(Nametag, MarginPopup):
                 bin = config.GetString('nametag-fixed-bin', 'fixed')
                 self.m_attached_np.setBin(bin, self.m_draw_order)
 
-        self.m_copied_np = self.m_group.copyNameTo(self.m_np)
+        self.m_copied_np = self.m_group.instanceNameTo(self.m_np)
         self.m_copied_np.setMat(a3)
         if self.m_has_draw_order:
             bin = config.GetString('nametag-fixed-bin', 'fixed')
@@ -222,9 +235,9 @@ class Nametag2d(Nametag, MarginPopup):
         if v84[3] != 1.0:
             self.m_copied_np.setTransparency(1)
 
-        reducer = SceneGraphReducer()
-        reducer.applyAttribs(self.m_copied_np.node())
-        reducer.applyAttribs(self.m_attached_np.node())
+        # The name and card geometry are shared (see NameGeometryCache), so
+        # their state stays on our nodes rather than being applied into
+        # the vertices.
 
         if NametagGlobals._arrow_model:
             self.m_arrow = NametagGlobals._arrow_model.copyTo(self.m_np)
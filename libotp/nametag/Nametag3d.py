@@ -3,6 +3,7 @@ import math
 from panda3d.core import *
 
 import NametagGlobals
+from NameGeometryCache import getNameGeometryCache
 from Nametag import Nametag
 from _constants import *
 
@@ -153,14 +154,8 @@ class Nametag3d(Nametag, PandaNode):
 
         v47 = None
         if v54[3] != 0.0:
-            card = CardMaker('nametag')
-            card.setFrame(self.m_name_frame)
-            card.setColor(v54)
-            if NametagGlobals._nametag_card:
-                card.setSourceGeometry(NametagGlobals._nametag_card.node(),
-                                       NametagGlobals._nametag_card_frame)
-
-            self.m_np_372 = self.m_np_top.attachNewNode(card.generate())
+            card = getNameGeometryCache().getCard(self.m_name_frame, v54)
+            self.m_np_372 = self.m_np_top.attachNewNode(card)
             self.m_np_372.setTransparency(1)
             v47 = self.m_np_372.find('**/+GeomNode')
 
@@ -170,7 +165,7 @@ class Nametag3d(Nametag, PandaNode):
                 self.m_group.m_name_icon.instanceTo(self.m_np_top)
 
             if v47:
-                self.m_np_360 = self.m_group.copyNameTo(v47)
+                self.m_np_360 = self.m_group.instanceNameTo(v47)
                 self.m_np_360.setDepthWrite(0)
                 self.m_np_360.setY(-0.01)  # Panda3D 1.10 hack to prevent z-fighting.
                 v47.node().setEffect(DecalEffect.make())
@@ -182,7 +177,7 @@ class Nametag3d(Nametag, PandaNode):
             label86 = True
 
         if label86:
-            self.m_np_360 = self.m_group.copyNameTo(self.m_np_top)
+            self.m_np_360 = self.m_group.instanceNameTo(self.m_np_top)
             if self.m_has_draw_order:
                 bin = config.GetString('nametag-fixed-bin', 'fixed')
                 self.m_name_icon.setBin(bin, self.m_draw_order + 1)
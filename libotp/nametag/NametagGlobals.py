@@ -491,5 +491,7 @@ def getChatBg(color_code, state):
 
 
 _margin_prop_seq = 0
+_position_snapshot_seq = 0
+_toon_inverse_mat = None
 _default_qt_color = Vec4(0.8, 0.8, 1, 1)
 _balloon_text_origin = Point3(1.0, 0, 2.0)
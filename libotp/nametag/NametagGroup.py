@@ -1,6 +1,7 @@
 from panda3d.core import *
 
 import NametagGlobals
+from NameGeometryCache import getNameGeometryCache
 from Nametag2d import Nametag2d
 from Nametag3d import Nametag3d
 from _constants import *
@@ -120,23 +121,11 @@ class NametagGroup:
         self.m_display_name = name
 
         if name and self.m_name_font:
-            text_node = NametagGlobals.getTextNode()
-            text_node.setFont(self.m_name_font)
-            text_node.setWordwrap(self.getNameWordwrap())
-            text_node.setAlign(TextNode.ACenter)
-            text_node.setText(name)
-            gen = text_node.generate()
-            self.m_node = gen
-            self.m_name_frame = text_node.getCardActual()
-
-            if self.m_has_shadow:
-                self.m_node = PandaNode('name')
-                self.m_node.addChild(gen)
-
-                pos = Point3(self.m_shadow[0], 0, -self.m_shadow[1])
-                attached = NodePath.anyPath(self.m_node).attachNewNode(gen.copySubgraph())
-                attached.setPos(pos)
-                attached.setColor(0, 0, 0, 1)
+            # Shared with every other group showing the same name, so it
+            # must only ever be instanced or copied, never changed.
+            shadow = tuple(self.m_shadow) if self.m_has_shadow else None
+            self.m_node, self.m_name_frame = getNameGeometryCache().getText(
+                name, self.m_name_font, self.getNameWordwrap(), shadow)
 
         else:
             self.m_node = None
@@ -413,6 +402,13 @@ class NametagGroup:
     def copyNameTo(self, to):
         return to.attachNewNode(self.m_node.copySubgraph())
 
+    def instanceNameTo(self, to):
+        # Like copyNameTo, but shares the name geometry. Set state on the
+        # returned node only.
+        np = to.attachNewNode('name')
+        np.node().addChild(self.m_node)
+        return np
+
     def displayAsActive(self):
         if self.m_is_active and NametagGlobals._master_nametags_active:
             return 1
@@ -12,6 +12,8 @@ from direct.interval.IntervalManager import ivalMgr
 from direct.task import Task
 from direct.showbase import EventManager
 from direct.showbase import ExceptionVarDump
+from otp.ai.AITaskProfiler import AITaskProfiler
+from otp.ai import CpuPlacement
 import math
 import sys
 import time
@@ -33,17 +35,33 @@ class AIBase:
         self.AISleep = self.config.GetFloat('ai-sleep', 0.04)
         self.AIRunningNetYield = self.config.GetBool('ai-running-net-yield', 0)
         self.AIForceSleep = self.config.GetBool('ai-force-sleep', 0)
+        self.MaxEpockSpeed = self.config.GetFloat('ai-max-epoch-speed', 1.0 / 30.0)
+        self.AINetYieldSlice = self.config.GetFloat('ai-net-yield-slice', 0.005)
+        self.pacingStats = {'epoch': self.MaxEpockSpeed,
+                            'slack': 0.0,
+                            'totalSlack': 0.0,
+                            'netWakes': 0}
         self.eventMgr = eventMgr
         self.messenger = messenger
         self.bboard = bulletinBoard
         self.taskMgr = taskMgr
         Task.TaskManager.taskTimerVerbose = self.config.GetBool('task-timer-verbose', 0)
         Task.TaskManager.extendedExceptions = self.config.GetBool('extended-exceptions', 0)
+        self.taskProfiler = AITaskProfiler(taskMgr,
+                                           window=self.config.GetFloat('task-profiler-window', 60.0),
+                                           reportPeriod=self.config.GetFloat('task-profiler-report-period', 0))
         self.sfxManagerList = None
         self.musicManager = None
         self.jobMgr = jobMgr
         self.hidden = NodePath('hidden')
-        self.graphicsEngine = GraphicsEngine()
+        # An AI never opens a window, so a headless shard does not need a
+        # GraphicsEngine (or a renderFrame call every frame) at all.
+        self.headless = self.config.GetBool('ai-headless', 0)
+        self.wantResetPrevTransform = self.config.GetBool('ai-reset-prev-transform', 1)
+        if self.headless:
+            self.graphicsEngine = None
+        else:
+            self.graphicsEngine = GraphicsEngine()
         globalClock = ClockObject.getGlobalClock()
         self.trueClock = TrueClock.getGlobalPtr()
         globalClock.setRealTime(self.trueClock.getShortTime())
@@ -85,11 +103,17 @@ class AIBase:
         self.wantSwitchboardHacks = self.config.GetBool('want-switchboard-hacks', 0)
         self.GEMdemoWhisperRecipientDoid = self.config.GetBool('gem-demo-whisper-recipient-doid', 0)
         self.sqlAvailable = self.config.GetBool('sql-available', 1)
+        self.__defaultDoYield = self.taskMgr.doYield
         self.createStats()
         self.restart()
+        if self.config.GetBool('want-task-profiler', 0):
+            self.taskProfiler.enable()
 
     
     def setupCpuAffinities(self, minChannel):
+        if self.config.GetString('cpu-placement-mode', 'manual') == 'auto':
+            if self.setupCpuPlacement():
+                return
         if game.name == 'uberDog':
             affinityMask = self.config.GetInt('uberdog-cpu-affinity-mask', -1)
         else:
@@ -113,16 +137,79 @@ class AIBase:
                     channelSet = int(minChannel / 1000000)
                     channelSet -= 240
                     affinity = channelSet + 3
-                    TrueClock.getGlobalPtr().setCpuAffinity(1 << (affinity % 4)
-    
+                    TrueClock.getGlobalPtr().setCpuAffinity(1 << (affinity % 4))
+
+    def setupCpuPlacement(self):
+        # Pins this process to its own core set out of a host-wide plan, so
+        # that co-located districts stop fighting over the same cores. Every
+        # AI/UD on the host must be started with the same process count and
+        # a distinct index.
+        numProcesses = self.config.GetInt('cpu-placement-processes', 1)
+        index = self.config.GetInt('cpu-placement-index', 0)
+        reserved = self.config.GetInt('cpu-placement-reserved', 0)
+        topology = CpuPlacement.readHostTopology()
+        plan = CpuPlacement.planPlacement(numProcesses, topology, reserved)
+        if not 0 <= index < len(plan):
+            self.notify.warning('No CPU placement for process %d of %d!' % (index, numProcesses))
+            return False
+        cpus = plan[index]
+        if not CpuPlacement.setProcessAffinity(cpus):
+            self.notify.warning('Could not pin process %d to cpus %s.' % (index, CpuPlacement.formatCpuList(cpus)))
+            return False
+        self.notify.info('Pinned process %d of %d to cpus %s.' % (index, numProcesses, CpuPlacement.formatCpuList(cpus)))
+        return True
+
     def taskManagerDoYield(self, frameStartTime, nextScheuledTaksTime):
         minFinTime = frameStartTime + self.MaxEpockSpeed
         if nextScheuledTaksTime > 0 and nextScheuledTaksTime < minFinTime:
-            minFinTime = nextScheuledTaksTime;
-        delta = minFinTime - globalClock.getRealTime();
+            minFinTime = nextScheuledTaksTime
+        delta = minFinTime - globalClock.getRealTime()
+        self.__recordSlack(delta)
         while delta > 0.002:
-            time.sleep(delta)           
-            delta = minFinTime - globalClock.getRealTime();
+            time.sleep(delta)
+            delta = minFinTime - globalClock.getRealTime()
+
+    def taskManagerDoYieldNetwork(self, frameStartTime, nextScheuledTaksTime):
+        # Like taskManagerDoYield, but we give the slack back to the network:
+        # as soon as a datagram shows up we handle it and end the epoch, so a
+        # busy shard drains its queue at full speed while an idle one sleeps.
+        minFinTime = frameStartTime + self.MaxEpockSpeed
+        if nextScheuledTaksTime > 0 and nextScheuledTaksTime < minFinTime:
+            minFinTime = nextScheuledTaksTime
+        delta = minFinTime - globalClock.getRealTime()
+        self.__recordSlack(delta)
+        # With several districts in the process, the scheduler polls them
+        # all within its per-district budgets instead of just simbase.air.
+        scheduler = getattr(self, 'districtScheduler', None)
+        air = getattr(self, 'air', None)
+        while delta > 0.002:
+            if scheduler is not None:
+                woke = scheduler.poll(min(delta, self.AINetYieldSlice)) > 0
+            else:
+                woke = air is not None and air.readerPollOnce()
+            if woke:
+                self.pacingStats['netWakes'] += 1
+                break
+            time.sleep(min(delta, self.AINetYieldSlice))
+            delta = minFinTime - globalClock.getRealTime()
+
+    def __recordSlack(self, slack):
+        slack = max(slack, 0.0)
+        self.pacingStats['slack'] = slack
+        self.pacingStats['totalSlack'] += slack
+        if self.wantStats:
+            self.pacingSlackPcollector.setLevel(slack * 1000.0)
+
+    def getPacingStats(self):
+        return dict(self.pacingStats)
+
+    def reportTaskProfile(self, count=20, window=None):
+        if not self.taskProfiler.enabled:
+            self.taskProfiler.enable()
+            return 'Task profiling was off; it is now on, try again in a few seconds.'
+        report = self.taskProfiler.getReport(count, window)
+        self.notify.info(report)
+        return report
 
     def createStats(self, hostname=None, port=None):
         if not self.wantStats:
@@ -134,6 +221,9 @@ class AIBase:
         if port is None:
             port = -1
         PStatClient.connect(hostname, port)
+        self.pacingEpochPcollector = PStatCollector('AI pacing:Epoch')
+        self.pacingSlackPcollector = PStatCollector('AI pacing:Slack')
+        self.pacingEpochPcollector.setLevel(self.MaxEpockSpeed * 1000.0)
         return PStatClient.isConnected()
 
     def __sleepCycleTask(self, task):
@@ -152,20 +242,39 @@ class AIBase:
         self.graphicsEngine.renderFrame()
         return Task.cont
 
+    def __headlessLoop(self, state):
+        # Stands in for igLoop on a headless shard. There is nothing to cull
+        # or draw; renderFrame was only keeping PStats ticking for us.
+        if self.wantStats:
+            PStatClient.mainTick()
+        return Task.cont
+
     def shutdown(self):
+        self.taskMgr.remove('resetPrevTransform')
         self.taskMgr.remove('ivalLoop')        
         self.taskMgr.remove('igLoop')
         self.taskMgr.remove('aiSleep')
+        self.taskMgr.doYield = self.__defaultDoYield
         self.eventMgr.shutdown()
 
     def restart(self):
         self.shutdown()
-        self.taskMgr.add(
-            self.__resetPrevTransform, 'resetPrevTransform', priority = -51)
+        # resetAllPrevTransform only visits the nodes whose transform changed
+        # since the last call, so it stays cheap even with thousands of
+        # distributed nodes; shards that never use fluid collisions can turn
+        # it off altogether with ai-reset-prev-transform 0.
+        if self.wantResetPrevTransform:
+            self.taskMgr.add(
+                self.__resetPrevTransform, 'resetPrevTransform', priority = -51)
         self.taskMgr.add(self.__ivalLoop, 'ivalLoop', priority = 20)
-        self.taskMgr.add(self.__igLoop, 'igLoop', priority = 50)
+        if self.headless:
+            self.taskMgr.add(self.__headlessLoop, 'igLoop', priority = 50)
+        else:
+            self.taskMgr.add(self.__igLoop, 'igLoop', priority = 50)
         if self.AISleep >= 0 and (not self.AIRunningNetYield or self.AIForceSleep):
             self.taskMgr.add(self.__sleepCycleTask, 'aiSleep', priority = 55)
+        elif self.AIRunningNetYield:
+            self.taskMgr.doYield = self.taskManagerDoYieldNetwork
         self.eventMgr.restart()
 
     def getRepository(self):
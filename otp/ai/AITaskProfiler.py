@@ -0,0 +1,168 @@
+from direct.directnotify.DirectNotifyGlobal import directNotify
+from direct.task import Task
+from collections import deque
+import os
+import sys
+import time
+
+
+if sys.platform == 'win32':
+    # time.clock() is wall time on Windows. os.times() reads the process's
+    # user and kernel time (GetProcessTimes); it only advances on scheduler
+    # ticks, so single samples are coarse but the totals add up.
+    def processTime():
+        user, system = os.times()[:2]
+        return user + system
+else:
+    # Process CPU time, with microsecond resolution.
+    processTime = time.clock
+
+
+class TaskCostSamples:
+    # Rolling window of (timestamp, wall, cpu) samples for one task name.
+
+    def __init__(self, maxSamples):
+        self.samples = deque(maxlen=maxSamples)
+
+    def add(self, now, wall, cpu):
+        self.samples.append((now, wall, cpu))
+
+    def prune(self, oldest):
+        while self.samples and self.samples[0][0] < oldest:
+            self.samples.popleft()
+
+    def getSummary(self):
+        walls = sorted(s[1] for s in self.samples)
+        cpus = sorted(s[2] for s in self.samples)
+        return {'calls': len(walls),
+                'total': sum(walls),
+                'cpu': sum(cpus),
+                'p50': self.__percentile(walls, 0.5),
+                'p99': self.__percentile(walls, 0.99),
+                'max': walls[-1] if walls else 0.0,
+                'cpuP50': self.__percentile(cpus, 0.5),
+                'cpuP99': self.__percentile(cpus, 0.99),
+                'cpuMax': cpus[-1] if cpus else 0.0}
+
+    def __percentile(self, values, fraction):
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class AITaskProfiler:
+    """
+    Keeps per-task wall and CPU time for every task on the task manager,
+    so we can tell which task is eating the frame budget.
+
+    Nothing is wrapped while the profiler is off; enabling it swaps each
+    PythonTask's function for a timing wrapper, and disabling it puts the
+    original functions back.
+    """
+    notify = directNotify.newCategory('AITaskProfiler')
+
+    ScanTaskName = 'aiTaskProfilerScan'
+
+    def __init__(self, taskMgr, window=60.0, maxSamples=4096, reportPeriod=0):
+        self.taskMgr = taskMgr
+        self.window = window
+        self.maxSamples = maxSamples
+        self.reportPeriod = reportPeriod
+        self.enabled = False
+        self.name2samples = {}
+        self.task2function = {}
+        self.lastReport = 0.0
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.__wrapTasks()
+        self.lastReport = time.time()
+        # Tasks added after we were enabled are picked up by this scan.
+        self.taskMgr.add(self.__scanTask, self.ScanTaskName, priority=60)
+        self.notify.info('Task profiling enabled.')
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.taskMgr.remove(self.ScanTaskName)
+        for task, function in self.task2function.values():
+            task.setFunction(function)
+        self.task2function = {}
+        self.notify.info('Task profiling disabled.')
+
+    def clear(self):
+        self.name2samples = {}
+
+    def __wrapTasks(self):
+        for task in self.taskMgr.getTasks():
+            if task.id in self.task2function or task.getName() == self.ScanTaskName:
+                continue
+            function = getattr(task, 'getFunction', lambda: None)()
+            if function is None or getattr(function, 'profiledFunction', None):
+                continue
+            self.task2function[task.id] = (task, function)
+            task.setFunction(self.__makeWrapper(task.getName(), function))
+
+        # Forget tasks that have been removed since the last scan.
+        for taskId, (task, function) in self.task2function.items():
+            if not task.isAlive():
+                del self.task2function[taskId]
+
+    def __makeWrapper(self, name, function):
+        def profiledTask(*args, **kArgs):
+            wallStart = time.time()
+            cpuStart = processTime()
+            try:
+                return function(*args, **kArgs)
+            finally:
+                wallEnd = time.time()
+                self.__record(name, wallEnd, wallEnd - wallStart, processTime() - cpuStart)
+
+        profiledTask.profiledFunction = function
+        return profiledTask
+
+    def __record(self, name, now, wall, cpu):
+        samples = self.name2samples.get(name)
+        if samples is None:
+            samples = TaskCostSamples(self.maxSamples)
+            self.name2samples[name] = samples
+        samples.add(now, wall, cpu)
+
+    def __scanTask(self, task):
+        self.__wrapTasks()
+        if self.reportPeriod > 0 and time.time() - self.lastReport >= self.reportPeriod:
+            self.lastReport = time.time()
+            self.notify.info(self.getReport())
+        return Task.cont
+
+    def getTopTasks(self, count=20, window=None):
+        if window is None:
+            window = self.window
+        oldest = time.time() - window
+        summaries = []
+        for name, samples in self.name2samples.items():
+            samples.prune(oldest)
+            if not samples.samples:
+                continue
+            summary = samples.getSummary()
+            summary['name'] = name
+            summaries.append(summary)
+
+        summaries.sort(key=lambda summary: summary['total'], reverse=True)
+        return summaries[:count]
+
+    def getReport(self, count=20, window=None):
+        if window is None:
+            window = self.window
+        lines = ['Top %d tasks over the last %ds (times in ms):' % (count, window),
+                 '%-32s %7s %9s %9s %8s %8s %8s' % ('task', 'calls', 'total', 'cpu', 'p50', 'p99', 'max')]
+        for summary in self.getTopTasks(count, window):
+            lines.append('%-32s %7d %9.2f %9.2f %8.3f %8.3f %8.3f' % (
+                summary['name'][:32], summary['calls'], summary['total'] * 1000.0,
+                summary['cpu'] * 1000.0, summary['p50'] * 1000.0,
+                summary['p99'] * 1000.0, summary['max'] * 1000.0))
+
+        return '\n'.join(lines)
@@ -0,0 +1,328 @@
+from direct.directnotify.DirectNotifyGlobal import directNotify
+from direct.distributed.PyDatagram import PyDatagram
+from direct.distributed.AstronInternalRepository import msgpack_encode
+from direct.task import Task
+import collections
+import errno
+import os
+import socket
+import struct
+
+RECORD_HEADER = struct.Struct('<I')
+
+
+class EventSpool:
+    """
+    Append-only file of length-prefixed event records. Records are only
+    ever appended, so a crash can at worst leave one torn record at the end,
+    which is dropped on replay.
+    """
+    notify = directNotify.newCategory('EventSpool')
+
+    def __init__(self, filename):
+        self.filename = filename
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def append(self, records):
+        f = open(self.filename, 'ab')
+        try:
+            f.write(''.join([RECORD_HEADER.pack(len(record)) + record for record in records]))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+
+    def rewrite(self, records):
+        # Swaps in a new spool in one rename, so a crash leaves either the
+        # old spool or the new one.
+        tempname = self.filename + '.tmp'
+        if os.path.exists(tempname):
+            os.remove(tempname)
+        EventSpool(tempname).append(records)
+        os.rename(tempname, self.filename)
+
+    def isEmpty(self):
+        return not os.path.exists(self.filename) or not os.path.getsize(self.filename)
+
+    def read(self):
+        if self.isEmpty():
+            return []
+
+        f = open(self.filename, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+
+        records = []
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            if offset + length > len(data):
+                self.notify.warning('Dropping a torn record at the end of %s.' % self.filename)
+                break
+            records.append(data[offset:offset + length])
+            offset += length
+
+        return records
+
+    def clear(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class BufferedEventLog:
+    """
+    Takes writeServerEvent off the hot path. Events are encoded straight
+    away but only sent to the event logger when the current frame reaches
+    maxFrameBytes/maxFrameEvents or has been open for flushInterval seconds.
+
+    The event logger is on UDP, where a refused port only shows up as an
+    error some time after the send. Sent records are therefore kept until
+    a later check of the socket finds no error; if it finds one, they go
+    to an on-disk spool along with everything after them. The spool is
+    replayed, oldest first, replayBatch records at a time and at most once
+    every replayInterval seconds, and records leave it only once the
+    socket has been checked again after they were sent.
+    """
+    notify = directNotify.newCategory('BufferedEventLog')
+
+    def __init__(self, host, port, eventLogId, spoolFilename, maxFrameBytes=65536,
+                 maxFrameEvents=512, flushInterval=0.25, retryInterval=5.0,
+                 replayBatch=256, replayInterval=0.1):
+        self.address = (host, port)
+        self.eventLogId = eventLogId
+        self.spool = EventSpool(spoolFilename)
+        self.maxFrameBytes = maxFrameBytes
+        self.maxFrameEvents = maxFrameEvents
+        self.flushInterval = flushInterval
+        self.retryInterval = retryInterval
+        self.replayBatch = replayBatch
+        self.replayInterval = replayInterval
+        self.frame = []
+        self.frameBytes = 0
+        self.frameStart = 0.0
+        # Records sent since the socket was last found healthy:
+        self.unconfirmed = []
+        # While replaying: the spooled records being replayed, how many of
+        # them have been sent and how many of those are confirmed.
+        self.replayRecords = None
+        self.replaySent = 0
+        self.replayConfirmed = 0
+        self.nextReplay = 0.0
+        self.socket = None
+        self.nextRetry = 0.0
+        self.stats = collections.Counter()
+        self.taskName = 'bufferedEventLog-%s' % id(self)
+
+    @classmethod
+    def install(cls, air):
+        # Replaces air.writeServerEvent with a buffered one, configured
+        # from the eventlog-* PRC variables.
+        host = config.GetString('eventlog-host', '')
+        if not host:
+            return None
+        port = 7197
+        if ':' in host:
+            host, port = host.split(':', 1)
+            port = int(port)
+
+        eventLogId = getattr(air, 'eventLogId', 'AIR:%d' % air.ourChannel)
+        spoolFilename = config.GetString('eventlog-spool', 'logs/eventlog-%s.spool' % air.ourChannel)
+        eventLog = cls(host, port, eventLogId, spoolFilename,
+                       maxFrameBytes=config.GetInt('eventlog-frame-bytes', 65536),
+                       maxFrameEvents=config.GetInt('eventlog-frame-events', 512),
+                       flushInterval=config.GetFloat('eventlog-flush-interval', 0.25),
+                       retryInterval=config.GetFloat('eventlog-retry-interval', 5.0),
+                       replayBatch=config.GetInt('eventlog-replay-batch', 256),
+                       replayInterval=config.GetFloat('eventlog-replay-interval', 0.1))
+        eventLog.start()
+        air.eventLog = eventLog
+        air.writeServerEvent = eventLog.writeServerEvent
+        return eventLog
+
+    def start(self):
+        taskMgr.add(self.__flushTask, self.taskName)
+
+    def stop(self):
+        taskMgr.remove(self.taskName)
+        self.flush()
+        self.__confirm()
+        if self.replayRecords is not None:
+            self.__stopReplay()
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def writeServerEvent(self, logtype, *args, **kwargs):
+        log = collections.OrderedDict()
+        log['type'] = logtype
+        log['sender'] = self.eventLogId
+        for i, v in enumerate(args):
+            log['_%d' % (i + 1)] = v
+
+        log.update(kwargs)
+
+        dg = PyDatagram()
+        msgpack_encode(dg, log)
+        self.__addRecord(dg.getMessage())
+
+    def __addRecord(self, record):
+        if not self.frame:
+            self.frameStart = globalClock.getRealTime()
+        self.frame.append(record)
+        self.frameBytes += len(record)
+        self.stats['events'] += 1
+        if self.frameBytes >= self.maxFrameBytes or len(self.frame) >= self.maxFrameEvents:
+            self.flush()
+
+    def __flushTask(self, task):
+        now = globalClock.getRealTime()
+        if self.frame and now - self.frameStart >= self.flushInterval:
+            self.flush()
+        elif self.unconfirmed:
+            self.__confirm()
+
+        if now >= self.nextReplay and (self.replayRecords is not None or not self.spool.isEmpty()):
+            self.__replayStep(now)
+        return Task.cont
+
+    def flush(self):
+        if not self.frame:
+            return
+
+        frame = self.frame
+        self.frame = []
+        self.frameBytes = 0
+        self.stats['frames'] += 1
+
+        # Anything already spooled must go out first, to keep the order.
+        if not self.__confirm() or self.replayRecords is not None or not self.spool.isEmpty():
+            self.__spool(frame)
+            return
+
+        sent = self.__send(frame)
+        if sent < len(frame):
+            # The socket failed under us, so the records sent just before
+            # may not have arrived either.
+            self.__spool(self.unconfirmed + frame)
+            self.unconfirmed = []
+            return
+
+        self.unconfirmed.extend(frame)
+
+    def __confirm(self):
+        # Checks on the records sent since the last check. Returns False if
+        # they had to be spooled.
+        if not self.unconfirmed:
+            return True
+        if self.__probe():
+            self.unconfirmed = []
+            return True
+
+        self.__spool(self.unconfirmed)
+        self.unconfirmed = []
+        return False
+
+    def __probe(self):
+        # A pending error on the socket (an ICMP port unreachable, most
+        # likely) means the last sends went nowhere.
+        if not self.socket:
+            return False
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.__disconnect(os.strerror(error))
+            return False
+        return True
+
+    def __spool(self, frame):
+        self.spool.append(frame)
+        self.stats['spooled'] += len(frame)
+
+    def __replayStep(self, now):
+        if self.replayRecords is None:
+            if not self.__connect():
+                return
+            self.replayRecords = self.spool.read()
+            self.replaySent = 0
+            self.replayConfirmed = 0
+
+        if self.replaySent > self.replayConfirmed:
+            if not self.__probe():
+                self.__stopReplay()
+                return
+            self.stats['replayed'] += self.replaySent - self.replayConfirmed
+            self.replayConfirmed = self.replaySent
+
+        if self.replayConfirmed == len(self.replayRecords):
+            self.notify.info('Replayed %d spooled events.' % len(self.replayRecords))
+            self.__stopReplay()
+            return
+
+        batch = self.replayRecords[self.replaySent:self.replaySent + self.replayBatch]
+        if self.__send(batch) < len(batch):
+            self.__stopReplay()
+            return
+
+        self.replaySent += len(batch)
+        self.nextReplay = now + self.replayInterval
+
+    def __stopReplay(self):
+        # Drops the confirmed records from the spool. Frames spooled while
+        # the replay ran are behind them and stay.
+        records = self.spool.read()
+        if self.replayConfirmed >= len(records):
+            self.spool.clear()
+        elif self.replayConfirmed:
+            self.spool.rewrite(records[self.replayConfirmed:])
+        self.replayRecords = None
+        self.replaySent = 0
+        self.replayConfirmed = 0
+
+    def __connect(self):
+        if self.socket:
+            return True
+        if globalClock.getRealTime() < self.nextRetry:
+            return False
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.connect(self.address)
+        except socket.error, e:
+            self.__disconnect(e)
+            return False
+        return True
+
+    def __disconnect(self, e):
+        self.notify.warning('Event logger %s:%d unreachable (%s); spooling events.' % (self.address + (e,)))
+        if self.socket:
+            self.socket.close()
+        self.socket = None
+        self.nextRetry = globalClock.getRealTime() + self.retryInterval
+
+    def __send(self, records):
+        # The event logger reads one event per packet, so records go out as
+        # a burst of sends on the connected socket. Returns how many were
+        # handed to the socket before it reported an error; that they
+        # arrived is only known after the next __probe.
+        if not self.__connect():
+            return 0
+        sent = 0
+        try:
+            for record in records:
+                self.socket.send(record)
+                sent += 1
+        except socket.error, e:
+            if e.args and e.args[0] not in (errno.ECONNREFUSED, errno.ENETUNREACH, errno.EHOSTUNREACH):
+                self.notify.warning('Unexpected error sending events: %s' % (e,))
+            self.__disconnect(e)
+        self.stats['sent'] += sent
+        return sent
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats['pending'] = len(self.frame)
+        stats['unconfirmed'] = len(self.unconfirmed)
+        return stats
@@ -0,0 +1,170 @@
+from direct.directnotify.DirectNotifyGlobal import directNotify
+import glob
+import os
+import sys
+
+notify = directNotify.newCategory('CpuPlacement')
+
+SYS_PATH = '/sys/devices/system'
+
+
+def parseCpuList(cpuList):
+    # Parses the kernel's cpulist format, e.g. '0-3,8-11'.
+    cpus = []
+    for part in cpuList.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+
+    return cpus
+
+
+def formatCpuList(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+
+    return ','.join([('%d' % start) if start == end else ('%d-%d' % (start, end))
+                     for start, end in ranges])
+
+
+def _readFile(path):
+    try:
+        f = open(path)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+
+
+def _getCoreKey(cpu, sysPath):
+    # Hyperthread siblings share a (package, core) pair; keeping them next to
+    # each other means a core set never splits a physical core.
+    topology = os.path.join(sysPath, 'cpu', 'cpu%d' % cpu, 'topology')
+    package = _readFile(os.path.join(topology, 'physical_package_id'))
+    core = _readFile(os.path.join(topology, 'core_id'))
+    if package is None or core is None:
+        return (0, cpu)
+    return (int(package), int(core))
+
+
+def readHostTopology(sysPath=SYS_PATH):
+    """
+    Returns the online CPUs of this host as a list of NUMA nodes, each a
+    list of CPU numbers ordered so that hyperthread siblings are adjacent.
+    """
+    nodes = []
+    for nodePath in sorted(glob.glob(os.path.join(sysPath, 'node', 'node[0-9]*')),
+                           key=lambda path: int(os.path.basename(path)[4:])):
+        cpuList = _readFile(os.path.join(nodePath, 'cpulist'))
+        if cpuList and cpuList.strip():
+            nodes.append(parseCpuList(cpuList))
+
+    if not nodes:
+        cpuList = _readFile(os.path.join(sysPath, 'cpu', 'online'))
+        if cpuList and cpuList.strip():
+            nodes.append(parseCpuList(cpuList))
+
+    if not nodes:
+        import multiprocessing
+        nodes.append(range(multiprocessing.cpu_count()))
+
+    return [sorted(cpus, key=lambda cpu: (_getCoreKey(cpu, sysPath), cpu)) for cpus in nodes]
+
+
+def planPlacement(numProcesses, topology, reserved=0):
+    """
+    Splits the host's CPUs into numProcesses disjoint core sets. Processes
+    are first shared out between the NUMA nodes in proportion to their size
+    and each node is then split between its processes, so no set spans two
+    nodes. The first reserved CPUs are left alone for the OS and the Astron
+    daemons. If there are more processes than CPUs, processes are doubled
+    up round-robin.
+    """
+    nodes = []
+    for node in topology:
+        node = [cpu for cpu in node]
+        skip = min(reserved, len(node))
+        reserved -= skip
+        if node[skip:]:
+            nodes.append(node[skip:])
+
+    cpus = [cpu for node in nodes for cpu in node]
+    if not cpus or numProcesses <= 0:
+        return []
+
+    if numProcesses >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in xrange(numProcesses)]
+
+    # Largest remainder apportionment of the processes between the nodes:
+    quotas = [float(numProcesses * len(node)) / len(cpus) for node in nodes]
+    counts = [int(quota) for quota in quotas]
+    byRemainder = sorted(xrange(len(nodes)), key=lambda i: quotas[i] - counts[i], reverse=True)
+    for i in byRemainder[:numProcesses - sum(counts)]:
+        counts[i] += 1
+
+    plan = []
+    for node, count in zip(nodes, counts):
+        if not count:
+            continue
+        perProcess, extra = divmod(len(node), count)
+        start = 0
+        for i in xrange(count):
+            end = start + perProcess + (1 if i < extra else 0)
+            plan.append(node[start:end])
+            start = end
+
+    return plan
+
+
+def formatPlan(plan, topology, names=None):
+    cpu2node = {}
+    for nodeIndex, node in enumerate(topology):
+        for cpu in node:
+            cpu2node[cpu] = nodeIndex
+
+    lines = []
+    for i, cpus in enumerate(plan):
+        name = names[i] if names and i < len(names) else 'process %d' % i
+        nodes = sorted(set([cpu2node.get(cpu, 0) for cpu in cpus]))
+        lines.append('%-20s cpus %-16s numa %s' % (name, formatCpuList(cpus),
+                                                   ','.join([str(node) for node in nodes])))
+
+    return '\n'.join(lines)
+
+
+def setProcessAffinity(cpus):
+    """
+    Pins the current process to the given CPUs. Returns True on success.
+    """
+    if not cpus:
+        return False
+
+    if sys.platform.startswith('linux'):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        maskType = ctypes.c_ulong * ((max(cpus) // (8 * ctypes.sizeof(ctypes.c_ulong))) + 1)
+        mask = maskType()
+        bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+        for cpu in cpus:
+            mask[cpu // bits] |= 1 << (cpu % bits)
+        if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+            notify.warning('sched_setaffinity failed: %s' % os.strerror(ctypes.get_errno()))
+            return False
+        return True
+
+    from panda3d.core import TrueClock
+    affinityMask = 0
+    for cpu in cpus:
+        affinityMask |= 1 << cpu
+    return TrueClock.getGlobalPtr().setCpuAffinity(affinityMask)
@@ -0,0 +1,96 @@
+from direct.directnotify.DirectNotifyGlobal import directNotify
+from direct.task import Task
+
+
+class DistrictScheduler:
+    """
+    Services the network for several AI repositories hosted in one process.
+
+    Each repository normally drains its whole datagram queue in its own
+    readerPollTask, so one busy district can hold the frame for as long as
+    it has traffic. The scheduler replaces those tasks with a single
+    round-robin poll that hands every district at most datagramBudget
+    datagrams per turn and stops the frame after timeBudget seconds.
+
+    AIStart does not use this yet: simbase.air is only switched while a
+    district's datagrams are handled, not for its timed tasks.
+    """
+    notify = directNotify.newCategory('DistrictScheduler')
+
+    TaskName = 'districtPoll'
+
+    def __init__(self, repositories, datagramBudget=100, timeBudget=0.05):
+        self.repositories = repositories
+        self.datagramBudget = datagramBudget
+        self.timeBudget = timeBudget
+        self.active = []
+        self.nextIndex = 0
+        self.air2datagrams = dict([(air, 0) for air in repositories])
+
+    def start(self):
+        # Must be called before the repositories connect, so that their
+        # poll tasks are routed to us from the start.
+        for air in self.repositories:
+            air.stopReaderPollTask()
+            air.startReaderPollTask = lambda air=air: self.__resume(air)
+            air.stopReaderPollTask = lambda air=air: self.__pause(air)
+
+        taskMgr.add(self.__pollTask, self.TaskName,
+                    priority=self.repositories[0].taskPriority)
+
+    def stop(self):
+        taskMgr.remove(self.TaskName)
+        for air in self.repositories:
+            del air.startReaderPollTask
+            del air.stopReaderPollTask
+            if air in self.active:
+                air.startReaderPollTask()
+        self.active = []
+
+    def __resume(self, air):
+        if air not in self.active:
+            self.active.append(air)
+
+    def __pause(self, air):
+        if air in self.active:
+            self.active.remove(air)
+
+    def __pollTask(self, task):
+        self.poll(self.timeBudget)
+        return Task.cont
+
+    def poll(self, timeBudget):
+        """
+        Serves every active district in turn, within the per-district
+        datagram budget, for at most timeBudget seconds. Returns the number
+        of datagrams handled.
+        """
+        deadline = globalClock.getRealTime() + timeBudget
+        total = 0
+        # Rotate the starting district so the first one in the list does not
+        # always get served first.
+        if self.active:
+            self.nextIndex = (self.nextIndex + 1) % len(self.active)
+        pending = self.active[self.nextIndex:] + self.active[:self.nextIndex]
+        while pending:
+            for air in pending[:]:
+                # Game code still reaches for simbase.air, so point it at the
+                # district whose datagrams are being handled.
+                simbase.air = air
+                handled = 0
+                while handled < self.datagramBudget and air in self.active and air.readerPollOnce():
+                    handled += 1
+                self.air2datagrams[air] += handled
+                total += handled
+                if handled < self.datagramBudget:
+                    pending.remove(air)
+
+            if globalClock.getRealTime() >= deadline:
+                break
+
+        simbase.air = self.repositories[0]
+        return total
+
+    def getDatagramCounts(self):
+        return dict([(air.districtName if hasattr(air, 'districtName') else air.ourChannel, count)
+                     for air, count in self.air2datagrams.items()])
@@ -0,0 +1,218 @@
+import __builtin__
+import hashlib
+import imp
+import marshal
+import os
+import sys
+import time
+
+BUNDLE_MAGIC = 'TTBRSB02' + imp.get_magic()
+
+
+class StartupBundle:
+    """
+    A single-file cache of the compiled code for every module a shard
+    imported on its previous start.
+
+    While installed on sys.meta_path it answers imports straight from the
+    bundle, skipping the sys.path search and the per-module .pyc reads.
+    Each entry carries the size and SHA-1 of its source file and falls
+    back to the regular import machinery as soon as the file on disk no
+    longer matches. Modification times are not trusted, since deploys with
+    rsync or cp -p keep them and an edit can land within the same second.
+    """
+
+    def __init__(self, filename, root=None):
+        self.filename = filename
+        self.root = os.path.abspath(root or os.getcwd())
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return False
+
+        try:
+            if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+                return False
+            self.entries = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            self.entries = {}
+            return False
+        finally:
+            f.close()
+
+        return True
+
+    def install(self):
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def __readSource(self, filename):
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def __getFingerprint(self, source):
+        return (len(source), hashlib.sha1(source).digest())
+
+    def __isCurrent(self, filename, fingerprint):
+        # The size check spares reading files that plainly changed.
+        try:
+            if os.path.getsize(filename) != fingerprint[0]:
+                return False
+        except OSError:
+            return False
+        source = self.__readSource(filename)
+        return source is not None and self.__getFingerprint(source) == fingerprint
+
+    # PEP 302 finder/loader:
+    def find_module(self, fullname, path=None):
+        entry = self.entries.get(fullname)
+        if entry is None:
+            return None
+        filename, isPackage, fingerprint, code = entry
+        if not self.__isCurrent(filename, fingerprint):
+            self.misses += 1
+            del self.entries[fullname]
+            return None
+        return self
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+
+        filename, isPackage, fingerprint, code = self.entries[fullname]
+        module = imp.new_module(fullname)
+        module.__file__ = filename
+        module.__loader__ = self
+        if isPackage:
+            module.__path__ = [os.path.dirname(filename)]
+            module.__package__ = fullname
+        else:
+            module.__package__ = fullname.rpartition('.')[0]
+        sys.modules[fullname] = module
+        try:
+            exec code in module.__dict__
+        except:
+            del sys.modules[fullname]
+            raise
+
+        self.hits += 1
+        return sys.modules[fullname]
+
+    def write(self):
+        # Snapshots every module loaded so far that lives under our root.
+        entries = {}
+        for name, module in sys.modules.items():
+            filename = getattr(module, '__file__', None)
+            if not module or not filename or name == '__main__':
+                continue
+            filename = os.path.abspath(filename)
+            if not filename.startswith(self.root + os.sep):
+                continue
+            if filename.endswith(('.pyc', '.pyo')):
+                filename = filename[:-1]
+            if not filename.endswith('.py'):
+                continue
+            source = self.__readSource(filename)
+            if source is None:
+                continue
+            fingerprint = self.__getFingerprint(source)
+            try:
+                code = compile(source.replace('\r\n', '\n') + '\n', filename, 'exec')
+            except SyntaxError:
+                continue
+            isPackage = os.path.basename(filename) == '__init__.py'
+            entries[name] = (filename, isPackage, fingerprint, code)
+
+        tempname = self.filename + '.tmp'
+        f = open(tempname, 'wb')
+        try:
+            f.write(BUNDLE_MAGIC)
+            marshal.dump(entries, f)
+        finally:
+            f.close()
+        os.rename(tempname, self.filename)
+        self.entries = entries
+        return len(entries)
+
+
+class ImportProfiler:
+    """
+    Times every module import while installed. Self time excludes the time
+    spent importing the module's own dependencies.
+    """
+
+    def __init__(self):
+        self.origImport = None
+        self.module2time = {}
+        # One [time spent in nested imports, modules they loaded] per import
+        # in progress:
+        self.stack = []
+        self.overhead = 0.0
+        self.startTime = time.time()
+
+    def install(self):
+        self.origImport = __builtin__.__import__
+        __builtin__.__import__ = self.__import
+
+    def uninstall(self):
+        if self.origImport:
+            __builtin__.__import__ = self.origImport
+            self.origImport = None
+
+    def __import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        # Only a plain 'import x' of a loaded module is sure to load
+        # nothing; 'from pkg import submod' and implicit relative imports
+        # can both load modules under other names.
+        if name in sys.modules and not fromlist:
+            return self.origImport(name, globals, locals, fromlist, level)
+
+        overheadStart = time.time()
+        before = set(sys.modules)
+        self.stack.append([0.0, set()])
+        start = time.time()
+        try:
+            return self.origImport(name, globals, locals, fromlist, level)
+        finally:
+            end = time.time()
+            elapsed = end - start
+            children, claimed = self.stack.pop()
+            # The modules this import itself loaded, under their real names:
+            loaded = [module for module in set(sys.modules) - before - claimed
+                      if sys.modules[module] is not None]
+            if loaded:
+                # 'import a.b.c' loads a, a.b and a.b.c in one go; the time
+                # goes to the deepest of them.
+                module = max(loaded, key=len)
+                total, selfTime = self.module2time.get(module, (0.0, 0.0))
+                self.module2time[module] = (total + elapsed, selfTime + elapsed - children)
+
+            overhead = (start - overheadStart) + (time.time() - end)
+            self.overhead += overhead
+            if self.stack and (loaded or claimed):
+                self.stack[-1][0] += elapsed + overhead
+                self.stack[-1][1].update(loaded)
+                self.stack[-1][1].update(claimed)
+
+    def getReport(self, count=30):
+        lines = ['Startup took %.3fs (%.3fs of it profiling); slowest %d imports (self/total ms):' % (
+            time.time() - self.startTime, self.overhead, count)]
+        ranked = sorted(self.module2time.items(), key=lambda item: item[1][1], reverse=True)
+        for name, (total, selfTime) in ranked[:count]:
+            lines.append('  %-48s %9.2f %9.2f' % (name, selfTime * 1000.0, total * 1000.0))
+
+        return '\n'.join(lines)
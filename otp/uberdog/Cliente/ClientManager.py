@@ -5,6 +5,8 @@ from direct.directnotify.DirectNotifyGlobal import directNotify
 
 from otp.distributed.PotentialAvatar import PotentialAvatar
 from otp.uberdog.AccountDetailRecord import AccountDetailRecord
+from otp.uberdog.NamePatternTables import getNamePatternTables
+from otp.uberdog.LoginVerifier import signLoginToken, DEFAULT_LOGIN_KEY
 
 from otp.otpbase import OTPGlobals
 
@@ -13,7 +15,7 @@ from datetime import datetime
 from libotp import WhisperPopup
 
 import simplejson as json
-import time, hmac
+import time
 
 class ClientManager(DistributedObject):
     notify = directNotify.newCategory('ClientManager')
@@ -31,10 +33,8 @@ class ClientManager(DistributedObject):
         token = base.cr.playToken
         base.cr.userName = token
 
-        key = 'GXyYBRWZazyXWS2jpvqnFB7d54EUwUdB'
-        digest_maker = hmac.new(key)
-        digest_maker.update(token)
-        clientKey = digest_maker.hexdigest()
+        clientKey = signLoginToken(token, config.GetString('login-hmac-key', DEFAULT_LOGIN_KEY),
+                                   config.GetString('login-hmac-digest', 'sha256'))
             
         self.sendUpdate('login', [token, clientKey])
 
@@ -217,6 +217,15 @@ class ClientManager(DistributedObject):
 
     def sendSetNamePattern(self, avId, p1, f1, p2, f2, p3, f3, p4, f4, callback):
         self._callback = callback
+
+        # The UberDOG would kick us for a pattern that does not make a name,
+        # so answer that one here instead of sending it.
+        if getNamePatternTables().getName([(p1, f1), (p2, f2), (p3, f3), (p4, f4)]) is None:
+            self.notify.warning('Refusing to send invalid name pattern for %d.' % avId)
+            taskMgr.doMethodLater(0, self.setNamePatternResp, 'rejectNamePattern',
+                                  extraArgs=[avId, 0])
+            return
+
         self.sendUpdate('setNamePattern', [avId, p1, f1, p2, f2, p3, f3, p4, f4])
 
     def setNamePatternResp(self, avId, status):
@@ -6,32 +6,435 @@ from direct.distributed.PyDatagram import PyDatagram
 from direct.distributed.MsgTypes import *
 
 from otp.otpbase import OTPGlobals
+from otp.uberdog.NameFilter import NameFilter
+from otp.uberdog.NamePatternTables import getNamePatternTables
+from otp.uberdog.LoginVerifier import LoginVerifier, DEFAULT_LOGIN_KEY
+from otp.uberdog.ConsistentHashRing import ConsistentHashRing
 
-from toontown.makeatoon.NameGenerator import NameGenerator
 from toontown.toon.ToonDNA import ToonDNA
 from toontown.toonbase import TTLocalizer
 
-from datetime import datetime
+from collections import OrderedDict, Counter, deque
 
-import anydbm, hmac, time, json, os
+import anydbm, copy, errno, math, time, json, os, threading, Queue
 
-blacklist = []
+nameFilter = None
 
-if blacklist:
-    blacklist = json.dumps(blacklist)
+def getNameFilter():
+    # The blacklist is compiled once, on the first name check.
+    global nameFilter
+    if nameFilter is None:
+        filename = config.GetString('name-blacklist', 'etc/name_blacklist.json')
+        if os.path.exists(filename):
+            nameFilter = NameFilter.load(filename)
+        else:
+            nameFilter = NameFilter()
+    return nameFilter
 
 def judgeName(name):
-    if not name:
-        return False
-    if blacklist:
-        for namePart in name.split(' '):
-            namePart = namePart.lower()
-            if len(namePart) < 1:
-                return False
-            for banned in blacklist.get(namePart[0], []):
-                if banned in namePart:
-                    return False
-    return True
+    return getNameFilter().isAllowed(name)
+
+# --- ACCOUNT TIMESTAMPS ---
+# CREATED and LAST_LOGIN hold seconds since the epoch, as a decimal string
+# (the fields are strings in the DC file). Older accounts still have
+# time.ctime() strings; those are parsed once and rewritten on next login.
+
+def parseAccountTimestamp(value):
+    # Returns (epoch seconds, is legacy), or (None, False) if unreadable.
+    if value.isdigit():
+        return int(value), False
+
+    try:
+        return int(time.mktime(time.strptime(value))), True
+    except ValueError:
+        return None, False
+
+def getAccountDays(created, now):
+    if created is None:
+        return -1
+    return abs(now - created) // 86400
+
+# --- ACCOUNT BRIDGE STORES ---
+# These map a user ID (the play token) to its account ID. Writes are queued
+# with put() and only made durable by commit(), so AccountDB can group-commit
+# the writes of many concurrent logins with a single flush.
+
+class AccountBridgeStore:
+    def get(self, userId):
+        pass  # Inheritors should override this.
+
+    def put(self, userId, accountId):
+        pass  # Inheritors should override this.
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DbmBridgeStore(AccountBridgeStore):
+    # The legacy store: whichever dbm backend anydbm happens to pick.
+
+    def __init__(self, filename):
+        self.dbm = anydbm.open(filename, 'c')
+
+    def get(self, userId):
+        if userId not in self.dbm:
+            return None
+        return int(self.dbm[userId])
+
+    def put(self, userId, accountId):
+        self.dbm[userId] = str(accountId)  # anydbm only allows strings.
+
+    def commit(self):
+        if getattr(self.dbm, 'sync', None):
+            self.dbm.sync()
+
+    def close(self):
+        self.dbm.close()
+
+
+class LogBridgeStore(AccountBridgeStore):
+    # An append-only log of [userId, accountId] JSON lines, indexed by an
+    # in-memory dict that is rebuilt when the log is opened.
+    notify = directNotify.newCategory('LogBridgeStore')
+
+    def __init__(self, filename):
+        self.index = {}
+        self.pending = []
+        torn = False
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                for line in f:
+                    torn = not line.endswith('\n')
+                    try:
+                        userId, accountId = json.loads(line)
+                    except ValueError:
+                        # Most likely a torn write at the end of the log.
+                        self.notify.warning('Skipping unreadable line in %s.' % filename)
+                        continue
+                    self.index[str(userId)] = accountId
+
+        self.log = open(filename, 'a')
+        if torn:
+            # Don't let the next record run on from the torn one.
+            self.pending.append('\n')
+
+    def get(self, userId):
+        return self.index.get(userId)
+
+    def put(self, userId, accountId):
+        self.index[userId] = accountId
+        self.pending.append(json.dumps([userId, accountId]) + '\n')
+
+    def commit(self):
+        if not self.pending:
+            return
+        self.log.write(''.join(self.pending))
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.pending = []
+
+    def close(self):
+        self.log.close()
+
+
+class SqliteBridgeStore(AccountBridgeStore):
+    # SQLite in WAL mode; lookups go through the primary key index.
+
+    def __init__(self, filename):
+        import sqlite3
+        # Lookups run on the AccountDB worker threads (under its store lock).
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS bridge (userId TEXT PRIMARY KEY, accountId INTEGER)')
+        self.db.commit()
+        self.pending = {}
+
+    def get(self, userId):
+        if userId in self.pending:
+            return self.pending[userId]
+        row = self.db.execute('SELECT accountId FROM bridge WHERE userId = ?', (userId,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put(self, userId, accountId):
+        self.pending[userId] = accountId
+
+    def commit(self):
+        if not self.pending:
+            return
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO bridge VALUES (?, ?)', self.pending.items())
+        self.pending = {}
+
+    def close(self):
+        self.db.close()
+
+# --- ACCOUNT LOOKUPS ---
+
+class AccountLookupCache:
+    # A bounded LRU of userId -> accountId. Reconnect storms after a shard
+    # crash look up the same users over and over again.
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, userId):
+        accountId = self.entries.pop(userId, None)
+        if accountId is None:
+            self.misses += 1
+            return None
+        self.entries[userId] = accountId
+        self.hits += 1
+        return accountId
+
+    def put(self, userId, accountId):
+        if self.maxSize <= 0:
+            return
+        self.entries.pop(userId, None)
+        self.entries[userId] = accountId
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def getHitRate(self):
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits) / total
+
+    def getStats(self):
+        return {'size': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'hitRate': self.getHitRate()}
+
+class AccountLookupPool:
+    # Runs blocking lookups on worker threads. The results are handed back to
+    # the main thread by a task, so callbacks always run inside the task loop.
+
+    def __init__(self, numThreads, name='accountLookup'):
+        self.requests = Queue.Queue()
+        self.results = Queue.Queue()
+        self.threads = []
+        for i in xrange(numThreads):
+            thread = threading.Thread(target=self.__work, name='%s-%d' % (name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+        if self.threads:
+            taskMgr.add(self.__resultTask, name + 'Results')
+
+    def submit(self, function, args, callback):
+        if not self.threads:
+            # Callbacks get the exception either way, as they do from a worker.
+            try:
+                result = function(*args)
+            except Exception, e:
+                result = e
+            callback(result)
+            return
+
+        self.requests.put((function, args, callback))
+
+    def __work(self):
+        while True:
+            function, args, callback = self.requests.get()
+            try:
+                result = function(*args)
+            except Exception, e:
+                result = e
+            self.results.put((callback, result))
+
+    def __resultTask(self, task):
+        while True:
+            try:
+                callback, result = self.results.get_nowait()
+            except Queue.Empty:
+                return task.cont
+            callback(result)
+
+# --- LOGIN ADMISSION ---
+
+class LoginAdmissionController:
+    """
+    Caps the number of LoginAccountFSMs running at once. Logins over the cap
+    wait in a FIFO queue, and queued clients are told their position with a
+    systemMessage, so a cluster restart doesn't flood the database with
+    every reconnecting client's queries at the same time.
+
+    A queued client that disconnects is dropped from the queue by a
+    post-remove. Before a queued login is admitted, its connection is asked
+    for its network address; a client agent that no longer has it won't
+    answer, and the login is dropped instead of doing account work for
+    nobody.
+    """
+    notify = directNotify.newCategory('LoginAdmissionController')
+
+    DisconnectMessage = 'loginQueueDisconnect'
+
+    def __init__(self, clientManager):
+        self.clientManager = clientManager
+        self.maxConcurrent = simbase.config.GetInt('login-max-concurrent', 0)
+        self.maxQueued = simbase.config.GetInt('login-queue-max', 5000)
+        self.queueTimeout = simbase.config.GetFloat('login-queue-timeout', 600.0)
+        self.updateInterval = simbase.config.GetFloat('login-queue-update-interval', 15.0)
+        self.probeTimeout = simbase.config.GetFloat('login-queue-probe-timeout', 5.0)
+
+        # Each entry is [sender, cookie, time queued]:
+        self.queue = deque()
+        self.queuedSenders = set()
+
+        # Logins taken off the queue, waiting to hear that their connection
+        # is still there, as sender -> (cookie, time queued):
+        self.probing = {}
+
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.disconnected = 0
+        self.waitTimes = deque(maxlen=1000)
+
+        if self.maxConcurrent > 0:
+            self.clientManager.air.netMessenger.register(
+                simbase.config.GetInt('login-queue-message-code', 40), self.DisconnectMessage)
+            self.clientManager.air.netMessenger.accept(self.DisconnectMessage, self, self.__handleDisconnect)
+            taskMgr.doMethodLater(self.updateInterval, self.__updateTask, 'loginQueueUpdate')
+
+    def destroy(self):
+        if self.maxConcurrent > 0:
+            self.clientManager.air.netMessenger.ignore(self.DisconnectMessage, self)
+            taskMgr.remove('loginQueueUpdate')
+        for sender in self.probing:
+            taskMgr.remove(self.__getProbeTaskName(sender))
+        self.probing = {}
+        self.queue.clear()
+        self.queuedSenders.clear()
+
+    def isQueued(self, sender):
+        return sender in self.queuedSenders or sender in self.probing
+
+    def remove(self, sender):
+        if sender in self.probing:
+            del self.probing[sender]
+            taskMgr.remove(self.__getProbeTaskName(sender))
+            # That frees up a slot.
+            self.loginFinished()
+            return
+
+        if sender not in self.queuedSenders:
+            return
+        self.queuedSenders.discard(sender)
+        for entry in self.queue:
+            if entry[0] == sender:
+                self.queue.remove(entry)
+                break
+
+    def request(self, sender, cookie):
+        # Starts the login right away if there's room, otherwise queues it.
+        if not self.queue and self.__hasRoom():
+            self.__admit(sender, cookie, 0.0)
+            return
+
+        if len(self.queue) >= self.maxQueued:
+            self.rejected += 1
+            self.clientManager.killConnection(sender, 'The server is too busy right now. Please try again later.')
+            return
+
+        self.queue.append([sender, cookie, globalClock.getRealTime()])
+        self.queuedSenders.add(sender)
+        self.__addDisconnectHook(sender)
+        self.__sendPosition(sender, len(self.queue))
+
+    def loginFinished(self):
+        # Called whenever a LoginAccountFSM is cleaned up.
+        while self.queue and self.__hasRoom():
+            sender, cookie, queueTime = self.queue.popleft()
+            self.queuedSenders.discard(sender)
+            self.__probe(sender, cookie, queueTime)
+
+    def __hasRoom(self):
+        # Logins being probed hold on to the slot they will be admitted into.
+        return self.maxConcurrent <= 0 or \
+            len(self.clientManager.connection2fsm) + len(self.probing) < self.maxConcurrent
+
+    def __addDisconnectHook(self, sender):
+        air = self.clientManager.air
+        datagramCleanup = air.netMessenger.prepare(self.DisconnectMessage, [sender])
+        datagram = PyDatagram()
+        datagram.addServerHeader(sender, air.ourChannel, CLIENTAGENT_ADD_POST_REMOVE)
+        datagram.addString(datagramCleanup.getMessage())
+        air.send(datagram)
+
+    def __handleDisconnect(self, sender):
+        if self.isQueued(sender):
+            self.disconnected += 1
+            self.remove(sender)
+
+    def __getProbeTaskName(self, sender):
+        return 'loginQueueProbe-%d' % sender
+
+    def __probe(self, sender, cookie, queueTime):
+        self.probing[sender] = (cookie, queueTime)
+        self.clientManager.air.getNetworkAddress(sender, lambda *address: self.__handleProbe(sender))
+        taskMgr.doMethodLater(self.probeTimeout, self.__probeTimeoutTask, self.__getProbeTaskName(sender),
+                              extraArgs=[sender])
+
+    def __handleProbe(self, sender):
+        entry = self.probing.pop(sender, None)
+        if entry is None:
+            return
+        taskMgr.remove(self.__getProbeTaskName(sender))
+        cookie, queueTime = entry
+        self.__admit(sender, cookie, globalClock.getRealTime() - queueTime)
+
+    def __probeTimeoutTask(self, sender):
+        if sender in self.probing:
+            self.disconnected += 1
+            self.remove(sender)
+
+    def __admit(self, sender, cookie, waitTime):
+        self.admitted += 1
+        self.waitTimes.append(waitTime)
+        self.clientManager.startLogin(sender, cookie)
+
+    def __sendPosition(self, sender, position):
+        self.clientManager.sendUpdateToChannel(sender, 'systemMessage', [
+            'The server is busy. You are number %d in the login queue.' % position])
+
+    def __updateTask(self, task):
+        # Drop logins that have waited too long (most likely the client gave
+        # up on us), then tell everyone else where they are now.
+        now = globalClock.getRealTime()
+        while self.queue and now - self.queue[0][2] > self.queueTimeout:
+            sender, cookie, queueTime = self.queue.popleft()
+            self.queuedSenders.discard(sender)
+            self.expired += 1
+            self.clientManager.killConnection(sender, 'Your login timed out in the queue.')
+
+        for position, (sender, cookie, queueTime) in enumerate(self.queue):
+            self.__sendPosition(sender, position + 1)
+
+        return task.again
+
+    def getStats(self):
+        waitTimes = sorted(self.waitTimes)
+        now = globalClock.getRealTime()
+        return {'active': len(self.clientManager.connection2fsm),
+                'queued': len(self.queue),
+                'probing': len(self.probing),
+                'oldestWait': now - self.queue[0][2] if self.queue else 0.0,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'expired': self.expired,
+                'disconnected': self.disconnected,
+                'waitP50': waitTimes[len(waitTimes) // 2] if waitTimes else 0.0,
+                'waitMax': waitTimes[-1] if waitTimes else 0.0}
 
 # --- ACCOUNT DATABASES ---
 # These classes make up the available account databases for Toontown.
@@ -48,8 +451,91 @@ class AccountDB:
         if not os.path.exists(FOLDER_PATH):
             os.makedirs(FOLDER_PATH)
 
-        filename = simbase.config.GetString('account-bridge-filename', 'otpd/databases/account-bridge.db')
-        self.dbm = anydbm.open(filename, 'c')
+        self.store = self.openStore()
+        self.storeLock = threading.Lock()
+        self.cache = AccountLookupCache(simbase.config.GetInt('account-lookup-cache-size', 10000))
+        self.lookupPool = AccountLookupPool(simbase.config.GetInt('account-lookup-threads', 2))
+
+        # Writes and commits run on their own thread, one batch at a time and
+        # in order, so the main loop never waits on the disk or the store lock.
+        # With account-lookup-threads 0 they run inline like the lookups.
+        numWriteThreads = 1 if self.lookupPool.threads else 0
+        self.writePool = AccountLookupPool(numWriteThreads, 'accountBridgeWrite')
+
+        # Writes waiting for the next group commit, as (userId, accountId, callback):
+        self.pendingStores = []
+
+        # userId -> accountId of every write not yet committed, so that a
+        # lookup can't miss an account that is still on its way to the store:
+        self.unwrittenStores = {}
+        self.commitInterval = simbase.config.GetFloat('account-bridge-commit-interval', 0.05)
+        self.commitBatchSize = simbase.config.GetInt('account-bridge-commit-batch', 256)
+
+    def openStore(self):
+        backend = simbase.config.GetString('account-bridge-backend', 'log')
+        dbmFilename = simbase.config.GetString('account-bridge-filename', 'otpd/databases/account-bridge.db')
+        if backend == 'anydbm':
+            return DbmBridgeStore(dbmFilename)
+
+        if backend == 'sqlite':
+            storeType = SqliteBridgeStore
+            filename = simbase.config.GetString('account-bridge-sqlite', 'otpd/databases/account-bridge.sqlite')
+        else:
+            storeType = LogBridgeStore
+            filename = simbase.config.GetString('account-bridge-log', 'otpd/databases/account-bridge.log')
+
+        if not os.path.exists(filename):
+            self.migrateDbm(dbmFilename, storeType, filename)
+
+        return storeType(filename)
+
+    def migrateDbm(self, dbmFilename, storeType, filename):
+        # Carry over the users of an existing anydbm bridge, if there is one.
+        # The new store is filled under a temporary name and only moved into
+        # place once every user is in it, so a migration that fails halfway is
+        # simply run again on the next start. Sharded ClientManagers share the
+        # SQLite file and may all get here at once: each fills a file of its
+        # own, and only the first to finish gets to move it into place.
+        try:
+            dbm = anydbm.open(dbmFilename, 'r')
+        except Exception:
+            return
+
+        tempname = '%s.migrating-%d' % (filename, os.getpid())
+        self.__removeStoreFiles(tempname)
+
+        store = storeType(tempname)
+        count = 0
+        try:
+            for userId in dbm.keys():
+                store.put(userId, int(dbm[userId]))
+                count += 1
+            store.commit()
+        finally:
+            store.close()
+            dbm.close()
+
+        try:
+            if hasattr(os, 'link'):
+                # Unlike rename, link won't replace a store someone else
+                # has already moved into place (and may be writing to).
+                os.link(tempname, filename)
+                os.remove(tempname)
+            else:
+                os.rename(tempname, filename)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            self.notify.info('%s was migrated by another ClientManager.' % filename)
+            self.__removeStoreFiles(tempname)
+            return
+
+        self.notify.info('Migrated %d users from %s.' % (count, dbmFilename))
+
+    def __removeStoreFiles(self, filename):
+        for leftover in (filename, filename + '-wal', filename + '-shm'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
 
     def addNameRequest(self, avId, name):
         return 'Success'
@@ -63,21 +549,83 @@ class AccountDB:
     def lookup(self, username, callback):
         pass  # Inheritors should override this.
 
+    def getStoredAccountId(self, userId):
+        # Called from the lookup worker threads.
+        with self.storeLock:
+            return self.store.get(userId)
+
+    def getUnwrittenAccountId(self, userId):
+        return self.unwrittenStores.get(userId)
+
     def storeAccountID(self, userId, accountId, callback):
-        self.dbm[str(userId)] = str(accountId)  # anydbm only allows strings.
-        if getattr(self.dbm, 'sync', None):
-            self.dbm.sync()
-            callback(True)
-        else:
-            self.notify.warning('Unable to associate user %s with account %d!' % (userId, accountId))
-            callback(False)
+        self.unwrittenStores[str(userId)] = accountId
+        self.cache.put(str(userId), accountId)
+        self.pendingStores.append((userId, accountId, callback))
+
+        if len(self.pendingStores) >= self.commitBatchSize:
+            self.commitStores()
+        elif len(self.pendingStores) == 1:
+            taskMgr.doMethodLater(self.commitInterval, self.__commitTask, 'accountBridgeCommit')
+
+    def __commitTask(self, task):
+        self.commitStores()
+        return task.done
+
+    def commitStores(self):
+        taskMgr.remove('accountBridgeCommit')
+        pendingStores = self.pendingStores
+        self.pendingStores = []
+        if not pendingStores:
+            return
+
+        self.writePool.submit(self.writeStores, (pendingStores,),
+                              lambda result: self.__handleStoresWritten(pendingStores, result))
+
+    def writeStores(self, pendingStores):
+        # Called from the write thread.
+        with self.storeLock:
+            for userId, accountId, callback in pendingStores:
+                self.store.put(str(userId), accountId)
+            self.store.commit()
+        return True
+
+    def __handleStoresWritten(self, pendingStores, result):
+        success = not isinstance(result, Exception)
+        if not success:
+            self.notify.warning('Unable to commit %d account bridge writes: %s' % (len(pendingStores), result))
+
+        for userId, accountId, callback in pendingStores:
+            if self.unwrittenStores.get(str(userId)) == accountId:
+                del self.unwrittenStores[str(userId)]
+            if not success:
+                self.notify.warning('Unable to associate user %s with account %d!' % (userId, accountId))
+            callback(success)
 
 class AccountHandler(AccountDB):
     notify = directNotify.newCategory('AccountHandler')
 
     def lookup(self, username, callback):
-        # Let's check if this user's ID is in your account database bridge:
-        if str(username) not in self.dbm:
+        userId = str(username)
+        accountId = self.getUnwrittenAccountId(userId)
+        if accountId is None:
+            accountId = self.cache.get(userId)
+        if accountId is not None:
+            self.__handleStoredAccountId(accountId, username, callback)
+            return
+
+        # Let's check if this user's ID is in your account database bridge.
+        # The bridge may be on a slow disk, so this happens off the main loop:
+        self.lookupPool.submit(self.getStoredAccountId, (userId,),
+                               lambda accountId: self.__handleStoredAccountId(accountId, username, callback))
+
+    def __handleStoredAccountId(self, accountId, username, callback):
+        if isinstance(accountId, Exception):
+            self.notify.warning('Account bridge lookup for %s failed: %s' % (username, accountId))
+            callback({'success': False,
+                      'reason': 'The account server could not look up your account.'})
+            return
+
+        if accountId is None:
 
             # Nope. Let's associate them with a brand new Account object!
             response = {
@@ -86,18 +634,222 @@ class AccountHandler(AccountDB):
                 'accountId': 0,
             }
             callback(response)
-            return response
 
         else:
 
             # We have an account already, let's return what we've got:
+            self.cache.put(str(username), accountId)
             response = {
                 'success': True,
                 'userId': username,
-                'accountId': int(self.dbm[str(username)]),
+                'accountId': int(accountId),
             }
             callback(response)
-            return response
+
+# --- ACCOUNT CACHE ---
+
+class AccountCache:
+    """
+    A short-lived cache of AccountUD fields by accountId, so one user going
+    through the pick-a-toon screen doesn't re-read their account from the
+    database for every operation. Our own updates are written through;
+    entries expire after ttl seconds and are dropped whenever an account is
+    killed or an avatar goes in-game (other servers may write to the
+    account from then on).
+    """
+
+    def __init__(self, ttl, maxSize):
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, accountId):
+        entry = self.entries.get(accountId)
+        if entry is None or globalClock.getRealTime() > entry[0]:
+            self.entries.pop(accountId, None)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # FSMs are free to modify what they get back.
+        return copy.deepcopy(entry[1])
+
+    def put(self, accountId, fields):
+        if self.ttl <= 0:
+            return
+        self.entries.pop(accountId, None)
+        self.entries[accountId] = (globalClock.getRealTime() + self.ttl, copy.deepcopy(fields))
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def update(self, accountId, fields):
+        entry = self.entries.get(accountId)
+        if entry is not None:
+            entry[1].update(copy.deepcopy(fields))
+
+    def invalidate(self, accountId):
+        self.entries.pop(accountId, None)
+
+    def getStats(self):
+        total = self.hits + self.misses
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'hitRate': float(self.hits) / total if total else 0.0}
+
+# --- DATAGRAM BATCHING ---
+
+class DatagramBatch:
+    """
+    Holds back every datagram sent through the repository while it is
+    open, then sends them all in order and flushes the connection once.
+    With collect-tcp on, that makes the whole batch a single write.
+    """
+
+    def __init__(self, air, name, stats):
+        self.air = air
+        self.name = name
+        self.stats = stats
+        self.datagrams = []
+        self.depth = 0
+        self.origSend = None
+
+    def open(self):
+        self.depth += 1
+        if self.depth == 1:
+            self.origSend = self.air.__dict__.get('send')
+            self.air.send = self.datagrams.append
+
+    def close(self):
+        self.depth -= 1
+        if self.depth:
+            return
+
+        if self.origSend is None:
+            del self.air.send
+        else:
+            self.air.send = self.origSend
+
+        datagrams = self.datagrams
+        self.datagrams = []
+        numBytes = 0
+        for datagram in datagrams:
+            numBytes += datagram.getLength()
+            self.air.send(datagram)
+
+        if datagrams and hasattr(self.air, 'flush'):
+            self.air.flush()
+
+        transitions, count, total = self.stats.get(self.name, (0, 0, 0))
+        self.stats[self.name] = (transitions + 1, count + len(datagrams), total + numBytes)
+
+def batchDatagrams(enterFunc):
+    # Decorates an FSM enter function so that everything it sends goes out
+    # as one DatagramBatch.
+    def enterBatched(self, *args, **kwargs):
+        batch = self.clientManager.getDatagramBatch('%s.%s' % (self.__class__.__name__, enterFunc.__name__))
+        batch.open()
+        try:
+            return enterFunc(self, *args, **kwargs)
+        finally:
+            batch.close()
+
+    enterBatched.__name__ = enterFunc.__name__
+    enterBatched.__doc__ = enterFunc.__doc__
+    return enterBatched
+
+# --- AVATAR QUERIES ---
+
+class AvatarBatchQuery:
+    """
+    Fetches a set of avatars from the database as one operation: the
+    queries all go out back to back, only ask for fieldNames, and the
+    callback runs once with {avId: fields} when the last one comes back
+    (or with None as soon as one of them fails).
+    """
+
+    def __init__(self, air, dclass, avIds, fieldNames, callback):
+        self.dclass = dclass
+        self.callback = callback
+        self.pending = set(avIds)
+        self.avatarFields = {}
+
+        if not self.pending:
+            self.__finish(self.avatarFields)
+            return
+
+        for avId in avIds:
+            air.dbInterface.queryObject(air.dbId, avId, self.__makeResponse(avId),
+                                        dclass, fieldNames)
+
+    def __makeResponse(self, avId):
+        return lambda dclass, fields: self.__handleResponse(avId, dclass, fields)
+
+    def __handleResponse(self, avId, dclass, fields):
+        if self.callback is None:
+            return
+
+        if dclass != self.dclass or fields is None:
+            self.__finish(None)
+            return
+
+        self.avatarFields[avId] = fields
+        self.pending.discard(avId)
+        if not self.pending:
+            self.__finish(self.avatarFields)
+
+    def __finish(self, result):
+        callback = self.callback
+        self.callback = None
+        callback(result)
+
+# --- OPERATION TIMEOUTS ---
+
+class OperationTimerWheel:
+    """
+    Hashed timer wheel holding the deadline of every running operation FSM.
+    Scheduling and cancelling are dict operations, and a single task
+    advances the wheel one slot per tick, so the cost doesn't grow with the
+    number of operations in flight.
+    """
+
+    def __init__(self, expireCallback, tickInterval=1.0, numSlots=64):
+        self.expireCallback = expireCallback
+        self.tickInterval = tickInterval
+        # Each slot maps an FSM to how many more turns of the wheel it has:
+        self.slots = [{} for i in xrange(numSlots)]
+        self.current = 0
+        self.fsm2slot = {}
+
+        taskMgr.doMethodLater(tickInterval, self.__tickTask, 'operationTimerWheel')
+
+    def schedule(self, fsm, timeout):
+        self.cancel(fsm)
+        ticks = max(1, int(math.ceil(timeout / self.tickInterval)))
+        slot = (self.current + ticks) % len(self.slots)
+        self.slots[slot][fsm] = (ticks - 1) // len(self.slots)
+        self.fsm2slot[fsm] = slot
+
+    def cancel(self, fsm):
+        slot = self.fsm2slot.pop(fsm, None)
+        if slot is not None:
+            del self.slots[slot][fsm]
+
+    def __tickTask(self, task):
+        self.current = (self.current + 1) % len(self.slots)
+        slot = self.slots[self.current]
+        expired = []
+        for fsm, rounds in slot.items():
+            if rounds:
+                slot[fsm] = rounds - 1
+            else:
+                expired.append(fsm)
+
+        for fsm in expired:
+            self.cancel(fsm)
+            self.expireCallback(fsm)
+
+        return task.again
 
 # --- FSMs ---
 class OperationFSM(FSM):
@@ -106,9 +858,28 @@ class OperationFSM(FSM):
     def __init__(self, clientManager, target):
         self.clientManager = clientManager
         self.target = target
+        self.startTime = globalClock.getRealTime()
+        self.finished = False
 
         FSM.__init__(self, self.__class__.__name__)
 
+        self.clientManager.operationTimers.schedule(self, self.getTimeout())
+
+    def getTimeout(self):
+        return self.clientManager.operationTimeout
+
+    def getAge(self):
+        return globalClock.getRealTime() - self.startTime
+
+    def demand(self, request, *args):
+        # A database response that shows up after we were killed (timed
+        # out, most likely) must not restart the operation.
+        if self.finished:
+            self.notify.debug('Ignoring %s request for finished %s.' % (request, self.name))
+            return
+
+        FSM.demand(self, request, *args)
+
     def enterKill(self, reason = ''):
         if self.TARGET_CONNECTION:
             self.clientManager.killConnection(self.target, reason)
@@ -117,8 +888,12 @@ class OperationFSM(FSM):
         self.demand('Off')
 
     def enterOff(self):
+        self.finished = True
+        self.clientManager.operationTimers.cancel(self)
+
         if self.TARGET_CONNECTION:
             del self.clientManager.connection2fsm[self.target]
+            self.clientManager.loginAdmission.loginFinished()
         else:
             del self.clientManager.account2fsm[self.target]
 
@@ -134,6 +909,10 @@ class LoginAccountFSM(OperationFSM):
         self.clientManager.accountDB.lookup(self.token, self.__handleLookup)
 
     def __handleLookup(self, result):
+        if self.state == 'Off':
+            # The lookup came back after we were killed.
+            return
+
         if not result.get('success'):
             self.clientManager.air.writeServerEvent('tokenRejected', self.target, self.token)
             self.demand('Kill', result.get('reason', 'The account server rejected your token.'))
@@ -148,7 +927,7 @@ class LoginAccountFSM(OperationFSM):
             self.demand('CreateAccount')
 
     def enterRetrieveAccount(self):
-        self.clientManager.air.dbInterface.queryObject(self.clientManager.air.dbId, self.accountId, self.__handleRetrieve)
+        self.clientManager.retrieveAccount(self.accountId, self.__handleRetrieve)
 
     def __handleRetrieve(self, dclass, fields):
         if dclass != self.clientManager.air.dclassesByName['AccountUD']:
@@ -165,8 +944,8 @@ class LoginAccountFSM(OperationFSM):
             'HOUSE_ID_SET': [0],
             'ESTATE_ID': 0,
             'ACCOUNT_AV_SET_DEL': [],
-            'CREATED': time.ctime(),
-            'LAST_LOGIN': time.ctime(),
+            'CREATED': str(int(time.time())),
+            'LAST_LOGIN': str(int(time.time())),
             'ACCOUNT_ID': str(self.userId)
         }
         self.clientManager.air.dbInterface.createObject(
@@ -186,6 +965,7 @@ class LoginAccountFSM(OperationFSM):
             return
 
         self.accountId = accountId
+        self.clientManager.accountCache.put(accountId, self.account)
         self.clientManager.air.writeServerEvent('accountCreated', accountId)
         self.demand('StoreAccountID')
 
@@ -196,12 +976,17 @@ class LoginAccountFSM(OperationFSM):
             self.__handleStored)
 
     def __handleStored(self, success = True):
+        if self.state == 'Off':
+            # The group commit finished after we were killed.
+            return
+
         if not success:
             self.demand('Kill', 'The account server could not save your user ID!')
             return
 
         self.demand('SetAccount')
 
+    @batchDatagrams
     def enterSetAccount(self):
         # If there's anybody on the account, kill them for redundant login:
         datagram = PyDatagram()
@@ -235,13 +1020,15 @@ class LoginAccountFSM(OperationFSM):
         # Un-sandbox them!
         self.clientManager.air.setClientState(self.target, 2)  # ESTABLISHED state.
 
-        # Update the last login timestamp:
-        self.clientManager.air.dbInterface.updateObject(
-            self.clientManager.air.dbId,
-            self.accountId,
-            self.clientManager.air.dclassesByName['AccountUD'],
-            {'LAST_LOGIN': time.ctime(),
-             'ACCOUNT_ID': str(self.userId)})
+        # Update the last login timestamp, and move an old ctime() creation
+        # date over to epoch seconds while we're at it:
+        now = int(time.time())
+        created, legacy = parseAccountTimestamp(self.account.get('CREATED', ''))
+        fields = {'LAST_LOGIN': str(now),
+                  'ACCOUNT_ID': str(self.userId)}
+        if legacy:
+            fields['CREATED'] = str(created)
+        self.clientManager.updateAccount(self.accountId, fields)
 
         responseData = {
             'returnCode': 0,
@@ -251,9 +1038,9 @@ class LoginAccountFSM(OperationFSM):
             'chatCodeCreationRule': 'YES',
             'access': 'FULL',
             'WhiteListResponse': 'YES',
-            'lastLoggedInStr': self.getLastLoggedInStr(),
-            'accountDays': self.getAccountDays(),
-            'serverTime': int(time.time()),
+            'lastLoggedInStr': time.strftime('%Y-%m-%d %I:%M:%S', time.localtime(now)),
+            'accountDays': getAccountDays(created, now),
+            'serverTime': now,
             'toonAccountType': 'NO_PARENT_ACCOUNT',
             'userName': str(self.userId)
         }
@@ -262,34 +1049,9 @@ class LoginAccountFSM(OperationFSM):
 
         # We're done.
         self.clientManager.air.writeServerEvent('accountLogin', self.target, self.accountId, self.userId)
-        self.clientManager.sendUpdateToChannel(self.target, 'acceptLogin', [int(time.time()), responseBlob])
+        self.clientManager.sendUpdateToChannel(self.target, 'acceptLogin', [now, responseBlob])
         self.demand('Off')
 
-    def getLastLoggedInStr(self):
-        lastLoggedInStr = time.strftime('%Y-%m-%d %I:%M:%S')
-
-        return lastLoggedInStr
-
-    def getAccountCreationDate(self):
-        accountCreationDate = self.account.get('CREATED', '')
-
-        try:
-            accountCreationDate = datetime.fromtimestamp(time.mktime(time.strptime(accountCreationDate)))
-        except ValueError:
-            accountCreationDate = ''
-
-        return accountCreationDate
-
-    def getAccountDays(self):
-        accountCreationDate = self.getAccountCreationDate()
-        accountDays = -1
-
-        if accountCreationDate:
-            now = datetime.fromtimestamp(time.mktime(time.strptime(time.ctime())))
-            accountDays = abs((now - accountCreationDate).days)
-
-        return accountDays
-
 class CreateAvatarFSM(OperationFSM):
     notify = directNotify.newCategory('CreateAvatarFSM')
 
@@ -310,8 +1072,7 @@ class CreateAvatarFSM(OperationFSM):
         self.demand('RetrieveAccount')
 
     def enterRetrieveAccount(self):
-        self.clientManager.air.dbInterface.queryObject(
-            self.clientManager.air.dbId, self.target, self.__handleRetrieve)
+        self.clientManager.retrieveAccount(self.target, self.__handleRetrieve)
 
     def __handleRetrieve(self, dclass, fields):
         if dclass != self.clientManager.air.dclassesByName['AccountUD']:
@@ -363,10 +1124,8 @@ class CreateAvatarFSM(OperationFSM):
     def enterStoreAvatar(self):
         # Associate the avatar with the account...
         self.avList[self.index] = self.avId
-        self.clientManager.air.dbInterface.updateObject(
-            self.clientManager.air.dbId,
+        self.clientManager.updateAccount(
             self.target,
-            self.clientManager.air.dclassesByName['AccountUD'],
             {'ACCOUNT_AV_SET': self.avList},
             {'ACCOUNT_AV_SET': self.account['ACCOUNT_AV_SET']},
             self.__handleStoreAvatar)
@@ -386,8 +1145,7 @@ class AvatarOperationFSM(OperationFSM):
 
     def enterRetrieveAccount(self):
         # Query the account:
-        self.clientManager.air.dbInterface.queryObject(
-            self.clientManager.air.dbId, self.target, self.__handleRetrieve)
+        self.clientManager.retrieveAccount(self.target, self.__handleRetrieve)
 
     def __handleRetrieve(self, dclass, fields):
         if dclass != self.clientManager.air.dclassesByName['AccountUD']:
@@ -411,30 +1169,21 @@ class GetAvatarsFSM(AvatarOperationFSM):
         self.demand('RetrieveAccount')
 
     def enterQueryAvatars(self):
-        self.pendingAvatars = set()
-        self.avatarFields = {}
-        for avId in self.avList:
-            if avId:
-                self.pendingAvatars.add(avId)
-
-                def response(dclass, fields, avId=avId):
-                    if self.state != 'QueryAvatars':
-                        return
-                    if dclass != self.clientManager.air.dclassesByName['DistributedToonUD']:
-                        self.demand('Kill', "One of the account's avatars is invalid!")
-                        return
-                    self.avatarFields[avId] = fields
-                    self.pendingAvatars.remove(avId)
-                    if not self.pendingAvatars:
-                        self.demand('SendAvatars')
-
-                self.clientManager.air.dbInterface.queryObject(
-                    self.clientManager.air.dbId,
-                    avId,
-                    response)
+        self.clientManager.queryAvatars(
+            [avId for avId in self.avList if avId], self.__handleQueryAvatars)
+
+    def __handleQueryAvatars(self, avatarFields):
+        # (state is None if there were no avatars to query and we're still
+        # inside enterQueryAvatars.)
+        if self.state not in ('QueryAvatars', None):
+            return
+
+        if avatarFields is None:
+            self.demand('Kill', "One of the account's avatars is invalid!")
+            return
 
-        if not self.pendingAvatars:
-            self.demand('SendAvatars')
+        self.avatarFields = avatarFields
+        self.demand('SendAvatars')
 
     def enterSendAvatars(self):
         potentialAvs = []
@@ -508,10 +1257,8 @@ class DeleteAvatarFSM(GetAvatarsFSM):
                  'setSlot%dItems' % index: [[]]}
             )
 
-        self.clientManager.air.dbInterface.updateObject(
-            self.clientManager.air.dbId,
+        self.clientManager.updateAccount(
             self.target,
-            self.clientManager.air.dclassesByName['AccountUD'],
             {'ACCOUNT_AV_SET': self.avList,
              'ACCOUNT_AV_SET_DEL': avsDeleted},
             {'ACCOUNT_AV_SET': self.account['ACCOUNT_AV_SET'],
@@ -614,19 +1361,10 @@ class SetNamePatternFSM(AvatarOperationFSM):
 
     def enterSetName(self):
         # Render the pattern into a string:
-        parts = []
-        for p, f in self.pattern:
-            part = self.clientManager.nameGenerator.nameDictionary.get(p, ('', ''))[1]
-            if f:
-                part = part[:1].upper() + part[1:]
-            else:
-                part = part.lower()
-            parts.append(part)
-
-        parts[2] += parts.pop(3) # Merge 2&3 (the last name) as there should be no space.
-        while '' in parts:
-            parts.remove('')
-        name = ' '.join(parts)
+        name = self.clientManager.namePatternTables.getName(self.pattern)
+        if name is None:
+            self.demand('Kill', 'Invalid name pattern!')
+            return
 
         self.clientManager.air.dbInterface.updateObject(
             self.clientManager.air.dbId,
@@ -752,6 +1490,7 @@ class LoadAvatarFSM(AvatarOperationFSM):
         dg.appendData(otherPacker.getString())
         self.clientManager.air.send(dg)
 
+    @batchDatagrams
     def enterSetAvatar(self):
         # Get the client channel.
         channel = self.clientManager.GetAccountConnectionChannel(self.target)
@@ -773,12 +1512,8 @@ class LoadAvatarFSM(AvatarOperationFSM):
         self.clientManager.air.send(datagram)
 
         # We will now set the account's days since creation on the client.
-        creationDate = self.getCreationDate()
-        accountDays = -1
-
-        if creationDate:
-            now = datetime.fromtimestamp(time.mktime(time.strptime(time.ctime())))
-            accountDays = abs((now - creationDate).days)
+        created, legacy = parseAccountTimestamp(self.account.get('CREATED', ''))
+        accountDays = getAccountDays(created, int(time.time()))
 
         if accountDays < 0:
             accountDays = 100000
@@ -841,20 +1576,13 @@ class LoadAvatarFSM(AvatarOperationFSM):
         datagram.addString(cleanupDatagram.getMessage())
         self.clientManager.air.send(datagram)
 
+        # The avatar is going in-game, where other servers may write to the
+        # account (estates, for one), so stop trusting our copy of it.
+        self.clientManager.accountCache.invalidate(self.target)
+
         self.clientManager.air.writeServerEvent('avatarChosen', self.avId, self.target)
         self.demand('Off')
 
-    def getCreationDate(self):
-        # Based on game creation date:
-        creationDate = self.account.get('CREATED', '')
-
-        try:
-            creationDate = datetime.fromtimestamp(time.mktime(time.strptime(creationDate)))
-        except ValueError:
-            creationDate = ''
-
-        return creationDate
-
 class UnloadAvatarFSM(OperationFSM):
     notify = directNotify.newCategory('UnloadAvatarFSM')
 
@@ -864,6 +1592,7 @@ class UnloadAvatarFSM(OperationFSM):
         # We don't even need to query the account, we know the avatar is being played!
         self.demand('UnloadAvatar')
 
+    @batchDatagrams
     def enterUnloadAvatar(self):
         # Get the client channel.
         channel = self.clientManager.GetAccountConnectionChannel(self.target)
@@ -932,15 +1661,132 @@ class ClientManagerUD(DistributedObjectGlobalUD):
         self.connection2fsm = {}
         self.account2fsm = {}
 
+        # Several ClientManagerUDs can share the load. They all receive (and
+        # Astron makes each of them unpack) every message sent to the
+        # ClientManager, since they share its doId; each one only handles the
+        # play tokens and accounts that hash onto it, so all operations on
+        # one account still run on one instance and account2fsm still keeps
+        # them apart. What is split is the handling: database work, HMACs,
+        # FSMs.
+        self.shardCount = simbase.config.GetInt('clientmanager-shard-count', 1)
+        self.shardIndex = simbase.config.GetInt('clientmanager-shard-index', 0)
+        self.shardRing = ConsistentHashRing(['shard-%d' % i for i in xrange(self.shardCount)])
+        self.shardName = 'shard-%d' % self.shardIndex
+        if self.shardCount > 1:
+            # Only SQLite copes with several processes writing to one file.
+            # Every shard needs to see every play token's account, so the
+            # other bridges can't be split up per shard either.
+            if simbase.config.GetString('account-bridge-backend', 'log') != 'sqlite':
+                self.notify.error('clientmanager-shard-count > 1 requires account-bridge-backend sqlite.')
+
+            # A login runs on its play token's shard, which is not always
+            # the one that owns (and caches) the account. Updates to accounts
+            # owned elsewhere tell the owner to drop its copy:
+            self.air.netMessenger.register(simbase.config.GetInt('clientmanager-invalidate-message-code', 41),
+                                           'accountCacheInvalidate')
+            self.air.netMessenger.accept('accountCacheInvalidate', self, self.__handleAccountCacheInvalidate)
+
+        # Every operation gets a deadline, so a database response that never
+        # comes can't leave its entry above behind forever:
+        self.operationTimeout = simbase.config.GetFloat('operation-timeout', 30.0)
+        self.operationTimers = OperationTimerWheel(self.expireOperation,
+                                                   simbase.config.GetFloat('operation-timer-tick', 1.0))
+        self.expiredOperations = Counter()
+
+        # Datagram batches by FSM transition, and how many datagrams/bytes
+        # each has sent as {name: (transitions, datagrams, bytes)}:
+        self.name2datagramBatch = {}
+        self.datagramStats = {}
+
         # For processing name patterns.
-        self.nameGenerator = NameGenerator()
+        self.namePatternTables = getNamePatternTables()
 
-        # Temporary HMAC key:
-        self.key = 'GXyYBRWZazyXWS2jpvqnFB7d54EUwUdB'
+        # Checks the HMAC on login cookies. The first key is the current one;
+        # the rest are old keys still accepted while clients roll over.
+        keys = simbase.config.GetString('login-hmac-keys', DEFAULT_LOGIN_KEY).split()
+        legacyDigests = simbase.config.GetString('login-hmac-legacy-digests', 'md5').split()
+        self.loginVerifier = LoginVerifier(keys, simbase.config.GetString('login-hmac-digest', 'sha256'),
+                                           legacyDigests)
+
+        # Logins received this frame, verified together by verifyLoginsTask:
+        self.pendingLogins = []
 
         # Instantiate our account DB interface:
         self.accountDB = AccountHandler(self)
 
+        # Keeps the accounts of recent operations around for a little while:
+        self.accountCache = AccountCache(simbase.config.GetFloat('account-cache-ttl', 60.0),
+                                         simbase.config.GetInt('account-cache-size', 10000))
+
+        # Limits how many logins hit the database at once:
+        self.loginAdmission = LoginAdmissionController(self)
+
+    def delete(self):
+        if self.shardCount > 1:
+            self.air.netMessenger.ignore('accountCacheInvalidate', self)
+        self.loginAdmission.destroy()
+        DistributedObjectGlobalUD.delete(self)
+
+    def __handleAccountCacheInvalidate(self, accountId):
+        if self.isOurs(accountId):
+            self.accountCache.invalidate(accountId)
+
+    def retrieveAccount(self, accountId, callback):
+        # Accounts owned by another shard are never cached here; only the
+        # owner hears about every change to them.
+        if not self.isOurs(accountId):
+            self.air.dbInterface.queryObject(self.air.dbId, accountId, callback)
+            return
+
+        fields = self.accountCache.get(accountId)
+        if fields is not None:
+            callback(self.air.dclassesByName['AccountUD'], fields)
+            return
+
+        def handleRetrieve(dclass, fields):
+            if dclass == self.air.dclassesByName['AccountUD']:
+                self.accountCache.put(accountId, fields)
+            callback(dclass, fields)
+
+        self.air.dbInterface.queryObject(self.air.dbId, accountId, handleRetrieve)
+
+    def updateAccount(self, accountId, newFields, oldFields=None, callback=None):
+        dclass = self.air.dclassesByName['AccountUD']
+        if not self.isOurs(accountId):
+            self.air.dbInterface.updateObject(self.air.dbId, accountId, dclass, newFields, oldFields, callback)
+            self.air.netMessenger.send('accountCacheInvalidate', [accountId])
+            return
+
+        if callback is None:
+            self.accountCache.update(accountId, newFields)
+            self.air.dbInterface.updateObject(self.air.dbId, accountId, dclass, newFields, oldFields)
+            return
+
+        def handleUpdate(fields):
+            # A non-empty response means our old values didn't match, so our
+            # copy of the account is stale.
+            if fields:
+                self.accountCache.invalidate(accountId)
+            else:
+                self.accountCache.update(accountId, newFields)
+            callback(fields)
+
+        self.air.dbInterface.updateObject(self.air.dbId, accountId, dclass, newFields, oldFields, handleUpdate)
+
+    def getDatagramBatch(self, name):
+        batch = self.name2datagramBatch.get(name)
+        if batch is None:
+            batch = DatagramBatch(self.air, name, self.datagramStats)
+            self.name2datagramBatch[name] = batch
+        return batch
+
+    # The only avatar fields the pick-a-toon screen needs:
+    AVATAR_LIST_FIELDS = ('setName', 'setDNAString', 'WishNameState', 'WishName')
+
+    def queryAvatars(self, avIds, callback, fieldNames=AVATAR_LIST_FIELDS):
+        return AvatarBatchQuery(self.air, self.air.dclassesByName['DistributedToonUD'],
+                                avIds, fieldNames, callback)
+
     def killConnection(self, connId, reason):
         datagram = PyDatagram()
         datagram.addServerHeader(connId, self.air.ourChannel, CLIENTAGENT_EJECT)
@@ -958,6 +1804,7 @@ class ClientManagerUD(DistributedObjectGlobalUD):
         self.killConnection(connId, 'An operation is already underway: ' + fsm.name)
 
     def killAccount(self, accountId, reason):
+        self.accountCache.invalidate(accountId)
         self.killConnection(self.GetAccountConnectionChannel(accountId), reason)
 
     def killAccountFSM(self, accountId):
@@ -969,8 +1816,45 @@ class ClientManagerUD(DistributedObjectGlobalUD):
 
         self.killAccount(accountId, 'An operation is already underway: ' + fsm.name)
 
+    def expireOperation(self, fsm):
+        self.notify.warning('%s for %d timed out in state %s after %.1fs.' % (
+            fsm.name, fsm.target, fsm.state, fsm.getAge()))
+        self.expiredOperations[fsm.name] += 1
+        self.air.writeServerEvent('operationTimeout', fsm.target, fsm.name, fsm.state)
+        fsm.demand('Kill', 'The operation timed out. Please try again.')
+
+    def getOperationStats(self, ageBuckets=(1.0, 5.0, 15.0)):
+        # In-flight operations by FSM type: how many, the oldest's age and
+        # how many fall into each age bucket (the last is everything older).
+        stats = {}
+        for fsm in self.connection2fsm.values() + self.account2fsm.values():
+            entry = stats.get(fsm.name)
+            if entry is None:
+                entry = {'count': 0, 'oldest': 0.0, 'ages': [0] * (len(ageBuckets) + 1),
+                         'expired': self.expiredOperations[fsm.name]}
+                stats[fsm.name] = entry
+            age = fsm.getAge()
+            entry['count'] += 1
+            entry['oldest'] = max(entry['oldest'], age)
+            bucket = 0
+            while bucket < len(ageBuckets) and age >= ageBuckets[bucket]:
+                bucket += 1
+            entry['ages'][bucket] += 1
+
+        for name, expired in self.expiredOperations.items():
+            if name not in stats:
+                stats[name] = {'count': 0, 'oldest': 0.0, 'ages': [0] * (len(ageBuckets) + 1),
+                               'expired': expired}
+
+        return stats
+
+    def isOurs(self, key):
+        return self.shardCount <= 1 or self.shardRing.getNode(key) == self.shardName
+
     def runAccountFSM(self, fsmtype, *args):
         sender = self.air.getAccountIdFromSender()
+        if not self.isOurs(sender):
+            return
 
         if not sender:
             self.killAccount(sender, 'Client is not logged in.')
@@ -983,21 +1867,32 @@ class ClientManagerUD(DistributedObjectGlobalUD):
         self.account2fsm[sender].request('Start', *args)
 
     def login(self, cookie, authKey):
+        # Logins are sharded on the play token, so that only one instance
+        # ever creates the account for it.
+        if not self.isOurs(cookie):
+            return
+
         self.notify.debug('Received login cookie %r from %d' % (cookie, self.air.getMsgSender()))
 
-        sender = self.air.getMsgSender()
+        self.pendingLogins.append((self.air.getMsgSender(), cookie, authKey))
+        if len(self.pendingLogins) == 1:
+            taskMgr.add(self.__verifyLoginsTask, 'verifyLogins')
 
-        # Time to check this login to see if its authentic
-        digest_maker = hmac.new(self.key)
-        digest_maker.update(cookie)
-        serverKey = digest_maker.hexdigest()
-        if serverKey == authKey:
-            # This login is authentic!
-            pass
-        else:
-            # This login is not authentic.
-            self.killConnection(sender, ' ')
+    def __verifyLoginsTask(self, task):
+        pendingLogins = self.pendingLogins
+        self.pendingLogins = []
+        results = self.loginVerifier.verifyBatch([(cookie, authKey) for sender, cookie, authKey in pendingLogins])
+        for (sender, cookie, authKey), authentic in zip(pendingLogins, results):
+            if not authentic:
+                # This login is not authentic.
+                self.killConnection(sender, ' ')
+                continue
+
+            self.__startVerifiedLogin(sender, cookie)
+
+        return task.done
 
+    def __startVerifiedLogin(self, sender, cookie):
         if sender >> 32:
             self.killConnection(sender, 'Client is already logged in.')
             return
@@ -1006,6 +1901,14 @@ class ClientManagerUD(DistributedObjectGlobalUD):
             self.killConnectionFSM(sender)
             return
 
+        if self.loginAdmission.isQueued(sender):
+            self.loginAdmission.remove(sender)
+            self.killConnection(sender, 'An operation is already underway: login queue')
+            return
+
+        self.loginAdmission.request(sender, cookie)
+
+    def startLogin(self, sender, cookie):
         self.connection2fsm[sender] = LoginAccountFSM(self, sender)
         self.connection2fsm[sender].request('Start', cookie)
 
@@ -1032,6 +1935,9 @@ class ClientManagerUD(DistributedObjectGlobalUD):
     def chooseAvatar(self, avId):
         currentAvId = self.air.getAvatarIdFromSender()
         accountId = self.air.getAccountIdFromSender()
+        if not self.isOurs(accountId):
+            return
+
         if currentAvId and avId:
             self.killAccount(accountId, 'A Toon is already chosen!')
             return
@@ -0,0 +1,42 @@
+import bisect, hashlib, struct
+
+class ConsistentHashRing:
+    """
+    Maps keys onto a set of named nodes. Every node is placed on the ring
+    at replicas points, and a key belongs to the first node point at or
+    after its own hash. Adding or removing a node only moves the keys in
+    the arcs that node gains or loses.
+    """
+
+    def __init__(self, nodes=(), replicas=128):
+        self.replicas = replicas
+        self.points = []
+        self.point2node = {}
+        for node in nodes:
+            self.addNode(node)
+
+    def __hash(self, key):
+        return struct.unpack('>Q', hashlib.md5(str(key)).digest()[:8])[0]
+
+    def addNode(self, node):
+        for i in xrange(self.replicas):
+            point = self.__hash('%s#%d' % (node, i))
+            if point in self.point2node:
+                continue
+            self.point2node[point] = node
+            bisect.insort(self.points, point)
+
+    def removeNode(self, node):
+        for i in xrange(self.replicas):
+            point = self.__hash('%s#%d' % (node, i))
+            if self.point2node.get(point) == node:
+                del self.point2node[point]
+                self.points.remove(point)
+
+    def getNode(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect_left(self.points, self.__hash(key))
+        if index == len(self.points):
+            index = 0
+        return self.point2node[self.points[index]]
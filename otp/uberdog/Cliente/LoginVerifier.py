@@ -0,0 +1,70 @@
+import hashlib, hmac
+
+# The key the client and the UberDOG fall back on when none is configured.
+DEFAULT_LOGIN_KEY = 'GXyYBRWZazyXWS2jpvqnFB7d54EUwUdB'
+
+def signLoginToken(token, key=DEFAULT_LOGIN_KEY, digestName='sha256'):
+    # What the client sends along with its play token.
+    return hmac.new(key, token, getattr(hashlib, digestName)).hexdigest()
+
+class LoginVerifier:
+    """
+    Checks the HMAC a client sends with its play token.
+
+    The keyed inner/outer hash state of every accepted (key, digest) pair
+    is set up once; a check only copies it and hashes the token. Digests
+    are compared in constant time. The first key is the current one, and
+    the others are still accepted so that keys can be rotated without
+    locking out clients that have not picked up the new one yet.
+    legacyDigests are accepted as well, for clients that still sign with
+    the old default (MD5).
+    """
+
+    def __init__(self, keys, digestName='sha256', legacyDigests=()):
+        self.macs = []
+        for key in keys:
+            for name in (digestName,) + tuple(legacyDigests):
+                self.macs.append(hmac.new(key, digestmod=getattr(hashlib, name)))
+
+    def verify(self, token, authKey):
+        if not isinstance(token, str) or not isinstance(authKey, str):
+            return False
+
+        for mac in self.macs:
+            mac = mac.copy()
+            mac.update(token)
+            if hmac.compare_digest(mac.hexdigest(), authKey):
+                return True
+
+        return False
+
+    def verifyBatch(self, logins):
+        """
+        Checks a list of (token, authKey) pairs in one pass and returns a
+        list of booleans. Tokens that show up more than once (clients
+        retrying during a reconnect storm) are only hashed once per key.
+        """
+        compare = hmac.compare_digest
+        macs = self.macs
+        token2digests = {}
+        results = []
+        for token, authKey in logins:
+            if not isinstance(token, str) or not isinstance(authKey, str):
+                results.append(False)
+                continue
+
+            # Digests are worked out lazily, in key order, and kept for the
+            # next login with the same token.
+            digests = token2digests.setdefault(token, [])
+            result = False
+            for i in xrange(len(macs)):
+                if i == len(digests):
+                    mac = macs[i].copy()
+                    mac.update(token)
+                    digests.append(mac.hexdigest())
+                if compare(digests[i], authKey):
+                    result = True
+                    break
+            results.append(result)
+
+        return results
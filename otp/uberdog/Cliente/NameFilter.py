@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import json, unicodedata
+
+# Characters people use to dodge the filter, mapped onto the letter they
+# stand in for. Applied after accents are stripped.
+LOOKALIKES = {
+    u'0': u'o', u'1': u'i', u'3': u'e', u'4': u'a', u'5': u's',
+    u'7': u't', u'8': u'b', u'9': u'g', u'@': u'a', u'$': u's',
+    u'!': u'i', u'|': u'l', u'ß': u'ss', u'æ': u'ae',
+    u'œ': u'oe', u'ø': u'o', u'ı': u'i',
+}
+
+def normalize(text):
+    """
+    Folds a name down to the form the blacklist is matched against:
+    lowercase, no accents (so 'Ção' becomes 'cao') and look-alike
+    characters replaced by the letter they imitate.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text.lower())
+    return u''.join([LOOKALIKES.get(char, char) for char in text
+                     if not unicodedata.combining(char)])
+
+class NameFilter:
+    """
+    Aho-Corasick automaton over the normalized blacklist. A name is checked
+    in one pass over its characters, however many words are banned.
+
+    Matches never cross a space, since no banned word contains one; that
+    keeps the old per-word behaviour of judgeName.
+    """
+
+    def __init__(self, words=()):
+        # State 0 is the root. goto[state] maps a character to the next
+        # state, fail[state] is the longest proper suffix that is also a
+        # state and output[state] is a banned word ending here, if any.
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+        self.size = 0
+        for word in words:
+            self.addWord(word)
+        self.compile()
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Reads a blacklist file: either a JSON list of words, a JSON object
+        of {first letter: [words]} (the old format) or one word per line.
+        """
+        f = open(filename, 'rb')
+        try:
+            data = f.read().decode('utf-8-sig')
+        finally:
+            f.close()
+
+        try:
+            words = json.loads(data)
+        except ValueError:
+            words = data.splitlines()
+
+        if isinstance(words, dict):
+            words = [word for group in words.values() for word in group]
+
+        return cls(words)
+
+    def addWord(self, word):
+        word = normalize(word).strip()
+        if not word:
+            return
+
+        state = 0
+        for char in word:
+            nextState = self.goto[state].get(char)
+            if nextState is None:
+                nextState = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(None)
+                self.goto[state][char] = nextState
+            state = nextState
+
+        if self.output[state] is None:
+            self.size += 1
+        self.output[state] = word
+
+    def compile(self):
+        # Breadth-first, so that every state's fail link is ready before
+        # its children are visited.
+        queue = self.goto[0].values()
+        for state in queue:
+            self.fail[state] = 0
+
+        for state in queue:
+            for char, child in self.goto[state].iteritems():
+                queue.append(child)
+                failState = self.fail[state]
+                while failState and char not in self.goto[failState]:
+                    failState = self.fail[failState]
+                self.fail[child] = self.goto[failState].get(char, 0)
+                if self.output[child] is None:
+                    self.output[child] = self.output[self.fail[child]]
+
+    def search(self, name):
+        # Returns the first banned word found in the name, or None.
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        state = 0
+        for char in normalize(name):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                return output[state]
+
+        return None
+
+    def isAllowed(self, name):
+        if not name:
+            return False
+        if not self.size:
+            return True
+        for namePart in name.split(' '):
+            if not namePart:
+                return False
+        return self.search(name) is None
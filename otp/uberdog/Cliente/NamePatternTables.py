@@ -0,0 +1,93 @@
+class NamePatternTables:
+    """
+    NameGenerator's name parts decoded into flat tables indexed by part
+    index, so that a (p, f) name pattern can be checked and rendered with
+    list lookups instead of going through NameGenerator every time.
+
+    A pattern is four (index, flag) pairs: title, first name, last name
+    prefix and last name suffix. An index of -1 leaves the part out, and
+    a set flag capitalizes the part.
+    """
+
+    # NameGenerator categories each pattern slot may draw from:
+    BOY_TITLE, GIRL_TITLE, NEUTRAL_TITLE, BOY_FIRST, GIRL_FIRST, NEUTRAL_FIRST, \
+        CAP_PREFIX, LAST_PREFIX, LAST_SUFFIX = range(9)
+    SLOT_CATEGORIES = ((BOY_TITLE, GIRL_TITLE, NEUTRAL_TITLE),
+                       (BOY_FIRST, GIRL_FIRST, NEUTRAL_FIRST),
+                       (CAP_PREFIX, LAST_PREFIX),
+                       (LAST_SUFFIX,))
+
+    def __init__(self, nameDictionary, maxCached=50000):
+        size = max(nameDictionary.keys()) + 1 if nameDictionary else 0
+
+        # slotMasks[index] has bit n set if the part may go in slot n.
+        self.slotMasks = [0] * size
+        self.lowered = [''] * size
+        self.capitalized = [''] * size
+        for index, (category, part) in nameDictionary.items():
+            if index < 0:
+                continue
+            for slot, categories in enumerate(self.SLOT_CATEGORIES):
+                if category in categories:
+                    self.slotMasks[index] |= 1 << slot
+            self.lowered[index] = part.lower()
+            self.capitalized[index] = part[:1].upper() + part[1:]
+
+        self.size = size
+        self.maxCached = maxCached
+        self.pattern2name = {}
+
+    def isValid(self, pattern):
+        if len(pattern) != 4:
+            return False
+
+        empty = True
+        for slot, (p, f) in enumerate(pattern):
+            if p == -1:
+                continue
+            if not 0 <= p < self.size or not self.slotMasks[p] & (1 << slot):
+                return False
+            empty = False
+
+        return not empty
+
+    def getName(self, pattern):
+        """
+        Returns the name the pattern spells out, or None if the pattern is
+        invalid.
+        """
+        pattern = tuple([(p, bool(f)) for p, f in pattern])
+        name = self.pattern2name.get(pattern)
+        if name is not None:
+            return name
+
+        if not self.isValid(pattern):
+            return None
+
+        parts = []
+        for p, f in pattern:
+            if p == -1:
+                parts.append('')
+            elif f:
+                parts.append(self.capitalized[p])
+            else:
+                parts.append(self.lowered[p])
+
+        parts[2] += parts.pop(3) # Merge 2&3 (the last name) as there should be no space.
+        name = ' '.join([part for part in parts if part])
+
+        if len(self.pattern2name) >= self.maxCached:
+            self.pattern2name.clear()
+        self.pattern2name[pattern] = name
+        return name
+
+namePatternTables = None
+
+def getNamePatternTables():
+    # Built once per process, from the same NameGenerator data on the
+    # UberDOG and on the client.
+    global namePatternTables
+    if namePatternTables is None:
+        from toontown.makeatoon.NameGenerator import NameGenerator
+        namePatternTables = NamePatternTables(NameGenerator().nameDictionary)
+    return namePatternTables
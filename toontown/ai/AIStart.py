@@ -1,5 +1,4 @@
 from panda3d.core import *
-from otp.otpbase import PythonUtil
 import __builtin__
 
 import argparse
@@ -9,13 +8,41 @@ parser.add_argument('--base-channel', help='The base channel that the server wil
 parser.add_argument('--max-channels', help='The number of channels that the server will be able to use.')
 parser.add_argument('--stateserver', help='The control channel of this AI\'s designated State Server.')
 parser.add_argument('--district-name', help='The name of the district on this AI server.')
+parser.add_argument('--district-names',
+                    help='Comma-separated names of several districts to host in this one AI process.')
+parser.add_argument('--stateservers',
+                    help='Comma-separated State Server control channels, one per district in --district-names.')
 parser.add_argument('--astron-ip',
                     help='The IP address of the Astron Message Director that this AI will connect to.')
 parser.add_argument('--eventlogger-ip', help='The IP address of the Astron Event Logger that this AI will log to.')
+parser.add_argument('--placement-count', help='The number of AI/UD processes sharing this host, for automatic CPU placement.')
+parser.add_argument('--placement-index', help='The index of this process in the host\'s CPU placement plan.')
+parser.add_argument('--placement-dry-run', action='store_true',
+                    help='Print the CPU placement plan for this host and exit.')
+parser.add_argument('--startup-bundle',
+                    help='Load (and afterwards refresh) a precompiled import bundle at this path.')
+parser.add_argument('--profile-startup', action='store_true',
+                    help='Report the time spent importing each module during startup.')
 parser.add_argument('config', nargs='*', default=['etc/Configrc.exe.prc'],
                     help='PRC file(s) that will be loaded on this AI instance.')
 args = parser.parse_args()
 
+if args.profile_startup or args.startup_bundle:
+    from otp.ai.StartupBundle import StartupBundle, ImportProfiler
+
+importProfiler = None
+if args.profile_startup:
+    importProfiler = ImportProfiler()
+    importProfiler.install()
+
+startupBundle = None
+if args.startup_bundle:
+    startupBundle = StartupBundle(args.startup_bundle)
+    startupBundle.load()
+    startupBundle.install()
+
+from otp.otpbase import PythonUtil
+
 for prc in args.config:
     loadPrcFile(prc)
 
@@ -28,13 +55,30 @@ if args.stateserver:
     localConfig += 'air-stateserver %s\n' % args.stateserver
 if args.district_name:
     localConfig += 'district-name %s\n' % args.district_name
+if args.district_names:
+    localConfig += 'district-names %s\n' % args.district_names
+if args.stateservers:
+    localConfig += 'air-stateservers %s\n' % args.stateservers
 if args.astron_ip:
     localConfig += 'air-connect %s\n' % args.astron_ip
 if args.eventlogger_ip:
     localConfig += 'eventlog-host %s\n' % args.eventlogger_ip
+if args.placement_count:
+    localConfig += 'cpu-placement-mode auto\n'
+    localConfig += 'cpu-placement-processes %s\n' % args.placement_count
+if args.placement_index:
+    localConfig += 'cpu-placement-index %s\n' % args.placement_index
 
 loadPrcFileData('AI Args Config', localConfig)
 
+if args.placement_dry_run:
+    from otp.ai import CpuPlacement
+    topology = CpuPlacement.readHostTopology()
+    plan = CpuPlacement.planPlacement(ConfigVariableInt('cpu-placement-processes', 1).getValue(), topology,
+                                      ConfigVariableInt('cpu-placement-reserved', 0).getValue())
+    print CpuPlacement.formatPlan(plan, topology)
+    raise SystemExit
+
 
 class game:
     name = 'toontown'
@@ -47,9 +91,38 @@ from otp.ai.AIBaseGlobal import *
 
 from toontown.ai.ToontownAIRepository import ToontownAIRepository
 
-simbase.air = ToontownAIRepository(config.GetInt('air-base-channel', 401000000),
-                                   config.GetInt('air-stateserver', 10000),
-                                   config.GetString('district-name', 'Toon Valley'))
+districtNames = [name.strip() for name in config.GetString('district-names', '').split(',') if name.strip()]
+if not districtNames:
+    districtNames = [config.GetString('district-name', 'Toon Valley')]
+
+if len(districtNames) > 1:
+    # DistrictScheduler only points simbase.air at a district while it
+    # handles that district's datagrams. Timed tasks and intervals that read
+    # simbase.air would all act on the first district, so until those run
+    # in their own district's context too, it's one district per process.
+    raise SystemExit('Hosting several districts in one AI process (%s) is not supported yet; '
+                     'start one AI per district.' % ', '.join(districtNames))
+
+stateservers = [int(channel) for channel in config.GetString('air-stateservers', '').split(',') if channel.strip()]
+if not stateservers:
+    stateservers = [config.GetInt('air-stateserver', 10000)]
+
+# Every district gets its own block of channels after the base channel:
+baseChannel = config.GetInt('air-base-channel', 401000000)
+channelStep = config.GetInt('air-channel-allocation', 999999) + 1
+
+simbase.airs = []
+for i, districtName in enumerate(districtNames):
+    simbase.airs.append(ToontownAIRepository(baseChannel + i * channelStep,
+                                             stateservers[i % len(stateservers)],
+                                             districtName))
+
+simbase.air = simbase.airs[0]
+
+if config.GetBool('want-buffered-event-log', 0):
+    from otp.ai.BufferedEventLog import BufferedEventLog
+    for air in simbase.airs:
+        BufferedEventLog.install(air)
 
 host = config.GetString('air-connect', '127.0.0.1')
 port = 7199
@@ -57,7 +130,22 @@ if ':' in host:
     host, port = host.split(':', 1)
     port = int(port)
 
-simbase.air.connect(host, port)
+for air in simbase.airs:
+    air.connect(host, port)
+
+if importProfiler:
+    importProfiler.uninstall()
+    simbase.notify.info(importProfiler.getReport())
+
+if startupBundle:
+    def writeStartupBundle(task):
+        # By now the lazily imported modules are in as well.
+        startupBundle.uninstall()
+        simbase.notify.info('Startup bundle: %d hits, %d stale; wrote %d modules to %s.' % (
+            startupBundle.hits, startupBundle.misses, startupBundle.write(), startupBundle.filename))
+        return task.done
+
+    taskMgr.doMethodLater(config.GetFloat('startup-bundle-delay', 30.0), writeStartupBundle, 'writeStartupBundle')
 
 try:
     run()
@@ -68,3 +156,8 @@ except Exception:
     simbase.air.writeServerEvent('ai-exception', avId=simbase.air.getAvatarIdFromSender(),
                                  accId=simbase.air.getAccountIdFromSender(), exception=info)
     raise
+finally:
+    # Whatever way the AI goes down, send (or spool) the buffered events.
+    for air in simbase.airs:
+        if getattr(air, 'eventLog', None):
+            air.eventLog.stop()